@@ -0,0 +1,595 @@
+"""
+Offline benchmark of the cleanup pipeline against in-process stand-ins for ECR and the
+Kubernetes API. Registries and clusters are generated from a seed, so runs with the same
+arguments are comparable, and latency and throttling can be injected per API call.
+
+    python benchmark.py --repositories 5000 --images 2000 --signed 0.3 --pods 50000
+
+The registry is driven through main.run_target with a real botocore client, whose
+requests are answered in process instead of being sent, so request signing, parsing,
+instrument_client, the rate limits and the adaptive retries all run as in the job. Each
+phase reports its wall time, the API requests it made and its peak traced memory, and the
+target is broken down with the job's own phase metrics.
+
+Throttled requests are answered with ThrottlingException, so botocore backs off and retries
+them and they show up in the job's throttle and retry counters. The backoff is real too,
+which makes high throttle rates slow.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from unittest import mock
+
+import boto3
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+import main
+
+REGISTRY_ID = "000000000000"
+REGION = "us-east-1"
+REGISTRY = f"{REGISTRY_ID}.dkr.ecr.{REGION}.amazonaws.com"
+DAY = 86400
+
+# Page sizes of the real APIs
+DESCRIBE_REPOSITORIES_PAGE = 1000
+DESCRIBE_IMAGES_PAGE = 1000
+LIST_IMAGES_PAGE = 1000
+
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+COSIGN_SIGNATURE = "application/vnd.dev.cosign.artifact.sig.v1+json"
+
+
+def digest_of(*parts) -> str:
+    return "sha256:" + hashlib.sha256("/".join(map(str, parts)).encode()).hexdigest()
+
+
+def signature_digest(repository_name: str, index: int) -> str:
+    # The last 8 hex digits carry the index of the subject, so batch_get_image can answer
+    # without a lookup table
+    return digest_of(repository_name, index, "sig")[:-8] + f"{index:08x}"
+
+
+class FakeBody:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class FakeECR:
+    """
+    Stand-in for the ECR API, answering the requests of a botocore client through its
+    before-send event. Images are generated per repository when it is described, so a large
+    registry costs the benchmark no memory until it is scanned.
+    """
+
+    def __init__(
+        self,
+        repositories: int,
+        images: int,
+        signed: float = 0.3,
+        unapproved: float = 0.05,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        seed: int = 0,
+        now: int | None = None,
+    ):
+        """
+        :param repositories int: number of repositories in the registry
+        :param images int: container images per repository
+        :param signed float: fraction of images with a signature artifact, half of them
+            tagged the cosign way and half only reachable through their manifest subject
+        :param unapproved float: fraction of repositories tagged Approved=false
+        :param latency float: seconds every request takes, throttled ones included
+        :param throttle_rate float: probability that a request is answered with
+            ThrottlingException, below 1 so a call can get through
+        :param seed int: seed of the generated registry
+        :param now int: epoch seconds the push and pull times are generated around
+        """
+        if not 0 <= throttle_rate < 1:
+            raise ValueError(
+                f"throttle_rate must be at least 0 and below 1, not {throttle_rate}"
+            )
+        self.repository_count = repositories
+        self.image_count = images
+        self.signed = signed
+        self.unapproved = unapproved
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+        self.now = now or int(time.time())
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.deleted = 0
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def repository_name(self, index: int) -> str:
+        return f"team-{index % 50}/service-{index}"
+
+    def attach(self, client) -> None:
+        """
+        :param client boto3.client: ECR client whose requests are answered by this registry
+        """
+        client.meta.events.register("before-send.ecr", self.send)
+
+    def send(self, request, **kwargs) -> AWSResponse:
+        """
+        Answers a request in the ECR JSON protocol, errors included, so botocore parses and
+        retries it as it would a response of the real API.
+        :return response AWSResponse:
+        """
+        operation = request.headers["X-Amz-Target"].decode().rsplit(".", 1)[-1]
+        try:
+            self._call(operation)
+            status = 200
+            body = getattr(self, xform_name(operation))(**json.loads(request.body))
+        except ClientError as error:
+            status = error.response["ResponseMetadata"]["HTTPStatusCode"]
+            body = {
+                "__type": error.response["Error"]["Code"],
+                "message": error.response["Error"]["Message"],
+            }
+        return AWSResponse(
+            request.url,
+            status,
+            {"Content-Type": "application/x-amz-json-1.1"},
+            FakeBody(json.dumps(body).encode()),
+        )
+
+    def _call(self, operation: str) -> None:
+        """
+        Counts the request, simulates its latency and throttles it at throttle_rate.
+        """
+        with self.lock:
+            self.calls[operation] += 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ThrottlingException",
+                        "Message": "Rate exceeded",
+                    },
+                    "ResponseMetadata": {"HTTPStatusCode": 400},
+                },
+                operation,
+            )
+
+    def _page(self, key: str, name: str, generate, nextToken, maxResults) -> dict:
+        """
+        Serves one page of a paginated listing. The listing is generated on the first page
+        and kept until its last one is served.
+        """
+        start = int(nextToken or 0)
+        with self.lock:
+            items = self.pages.get((key, name))
+        if items is None:
+            items = generate()
+            with self.lock:
+                self.pages[(key, name)] = items
+        end = start + maxResults
+        page = {key: items[start:end]}
+        if end < len(items):
+            page["nextToken"] = str(end)
+        else:
+            with self.lock:
+                self.pages.pop((key, name), None)
+        return page
+
+    def repository_images(self, name: str) -> list:
+        """
+        :param name str: repository name
+        :return images list: describe_images entries of the repository, artifacts included
+        """
+        rng = random.Random(f"{self.seed}/{name}")
+        images = []
+        for i in range(self.image_count):
+            digest = digest_of(name, i)
+            image = {
+                "registryId": REGISTRY_ID,
+                "repositoryName": name,
+                "imageDigest": digest,
+                "imageTags": [f"v{i}"] if rng.random() < 0.8 else [],
+                "imageSizeInBytes": rng.randint(10, 500) * 1024 * 1024,
+                "imagePushedAt": self.now - rng.randint(0, 180) * DAY,
+                "imageManifestMediaType": OCI_MANIFEST,
+                "artifactMediaType": "application/vnd.oci.image.config.v1+json",
+            }
+            if rng.random() < 0.7:
+                image["lastRecordedPullTime"] = image["imagePushedAt"] + rng.randint(
+                    0, self.now - image["imagePushedAt"]
+                )
+            images.append(image)
+            if rng.random() < self.signed:
+                tags = []
+                if rng.random() < 0.5:
+                    tags = [f"sha256-{digest.removeprefix('sha256:')}.sig"]
+                images.append(
+                    {
+                        "registryId": REGISTRY_ID,
+                        "repositoryName": name,
+                        "imageDigest": signature_digest(name, i),
+                        "imageTags": tags,
+                        "imageSizeInBytes": 1024,
+                        "imagePushedAt": image["imagePushedAt"],
+                        "imageManifestMediaType": OCI_MANIFEST,
+                        "artifactMediaType": COSIGN_SIGNATURE,
+                    }
+                )
+        return images
+
+    def describe_registry(self) -> dict:
+        return {"registryId": REGISTRY_ID}
+
+    def describe_repositories(
+        self, nextToken=None, maxResults=DESCRIBE_REPOSITORIES_PAGE, **kwargs
+    ) -> dict:
+        def generate():
+            return [
+                {
+                    "registryId": REGISTRY_ID,
+                    "repositoryName": self.repository_name(i),
+                    "repositoryUri": f"{REGISTRY}/{self.repository_name(i)}",
+                    "repositoryArn": f"arn:aws:ecr:{REGION}:{REGISTRY_ID}:repository/{self.repository_name(i)}",
+                }
+                for i in range(self.repository_count)
+            ]
+
+        return self._page("repositories", "", generate, nextToken, maxResults)
+
+    def describe_images(
+        self, repositoryName, nextToken=None, maxResults=DESCRIBE_IMAGES_PAGE, **kwargs
+    ) -> dict:
+        return self._page(
+            "imageDetails",
+            repositoryName,
+            lambda: self.repository_images(repositoryName),
+            nextToken,
+            maxResults,
+        )
+
+    def list_images(
+        self, repositoryName, nextToken=None, maxResults=LIST_IMAGES_PAGE, **kwargs
+    ) -> dict:
+        def generate():
+            image_ids = []
+            for image in self.repository_images(repositoryName):
+                image_ids.append({"imageDigest": image["imageDigest"]})
+                # An image is listed once per tag, untagged ones without imageTag
+                for position, tag in enumerate(image["imageTags"]):
+                    if position:
+                        image_ids.append({"imageDigest": image["imageDigest"]})
+                    image_ids[-1]["imageTag"] = tag
+            return image_ids
+
+        return self._page("imageIds", repositoryName, generate, nextToken, maxResults)
+
+    def list_tags_for_resource(self, resourceArn: str) -> dict:
+        index = int(resourceArn.rsplit("-", 1)[-1])
+        approved = (
+            random.Random(f"{self.seed}/tags/{index}").random() >= self.unapproved
+        )
+        return {"tags": [{"Key": "Approved", "Value": str(approved).lower()}]}
+
+    def batch_get_image(self, repositoryName, imageIds, **kwargs) -> dict:
+        images = []
+        for image_id in imageIds:
+            index = int(image_id["imageDigest"][-8:], 16)
+            manifest = {
+                "mediaType": OCI_MANIFEST,
+                "subject": {"digest": digest_of(repositoryName, index)},
+            }
+            images.append({"imageId": image_id, "imageManifest": json.dumps(manifest)})
+        return {"images": images, "failures": []}
+
+    def batch_delete_image(self, repositoryName, imageIds, **kwargs) -> dict:
+        with self.lock:
+            self.deleted += len(imageIds)
+        return {"imageIds": imageIds, "failures": []}
+
+
+class FakeListResponse:
+    def __init__(self, page: dict):
+        self.data = json.dumps(page).encode()
+
+
+class FakeCluster:
+    """
+    Stand-in for the list_*_for_all_namespaces functions of the Kubernetes client. Pods
+    reference random images of the fake registry by tag, and report the digest they run.
+    """
+
+    def __init__(self, ecr: FakeECR, pods: int, seed: int = 0, latency: float = 0.0):
+        self.ecr = ecr
+        self.pods = pods
+        self.seed = seed
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def items(self, kind: str) -> int:
+        # Roughly one controller per ten pods, split across the controller kinds
+        return self.pods if kind == "Pod" else max(1, self.pods // 50)
+
+    def pod_spec(self, kind: str, index: int) -> tuple[dict, dict]:
+        rng = random.Random(f"{self.seed}/{kind}/{index}")
+        repository = self.ecr.repository_name(
+            rng.randrange(max(1, self.ecr.repository_count))
+        )
+        image = rng.randrange(max(1, self.ecr.image_count))
+        spec = {
+            "containers": [
+                {"name": "app", "image": f"{REGISTRY}/{repository}:v{image}"}
+            ]
+        }
+        status = {
+            "containerStatuses": [
+                {
+                    "imageID": f"docker-pullable://{REGISTRY}/{repository}@{digest_of(repository, image)}"
+                }
+            ]
+        }
+        return spec, status
+
+    def item(self, kind: str, index: int) -> dict:
+        spec, status = self.pod_spec(kind, index)
+        item = {
+            "metadata": {"namespace": f"ns-{index % 100}", "name": f"{kind}-{index}"}
+        }
+        if kind == "Pod":
+            item["spec"] = spec
+            item["status"] = status
+            return item
+        # Wrap the pod spec in the template path of the kind
+        node = item
+        for key in main.WORKLOAD_SPEC_PATHS[kind][:-1]:
+            node = node.setdefault(key, {})
+        node[main.WORKLOAD_SPEC_PATHS[kind][-1]] = spec
+        return item
+
+    def lister(self, kind: str):
+        def list_function(limit, _preload_content=True, _continue=None):
+            with self.lock:
+                self.calls[kind] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            start = int(_continue or 0)
+            end = min(start + limit, self.items(kind))
+            page = {
+                "metadata": {},
+                "items": [self.item(kind, i) for i in range(start, end)],
+            }
+            if end < self.items(kind):
+                page["metadata"]["continue"] = str(end)
+            return FakeListResponse(page)
+
+        return list_function
+
+    def listers(self, api_client=None) -> dict:
+        return {kind: self.lister(kind) for kind in main.WORKLOAD_SPEC_PATHS}
+
+
+class Phase:
+    """
+    Measures the wall time, API calls and peak traced memory of a block.
+    """
+
+    def __init__(self, name: str, counters: list, results: list, memory: bool):
+        self.name = name
+        self.counters = counters
+        self.results = results
+        self.memory = memory
+
+    def __enter__(self):
+        self.calls_before = sum(
+            (Counter(counter) for counter in self.counters), Counter()
+        )
+        if self.memory:
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        peak = tracemalloc.get_traced_memory()[1] if self.memory else None
+        calls = sum((Counter(counter) for counter in self.counters), Counter())
+        calls.subtract(self.calls_before)
+        self.results.append(
+            {
+                "phase": self.name,
+                "seconds": round(elapsed, 3),
+                "calls": {
+                    operation: count for operation, count in calls.items() if count
+                },
+                "peak_memory_bytes": peak,
+            }
+        )
+
+
+def run_benchmark(
+    repositories: int = 200,
+    images: int = 200,
+    signed: float = 0.3,
+    pods: int = 2000,
+    latency: float = 0.0,
+    throttle_rate: float = 0.0,
+    concurrency: int = 4,
+    seed: int = 0,
+    memory: bool = True,
+    delete_unapproved: bool = False,
+) -> dict:
+    """
+    Lists the workloads and runs main.run_target against a generated registry and cluster,
+    the way main does for a single target. Deletions are sent to the fake registry, so the
+    deletion loop is measured too.
+    :return results dict: per phase measurements, the job's own phase breakdown and API
+    counters, and totals
+    """
+    ecr = FakeECR(
+        repositories,
+        images,
+        signed,
+        latency=latency,
+        throttle_rate=throttle_rate,
+        seed=seed,
+    )
+    cluster = FakeCluster(ecr, pods, seed=seed)
+    counters = [ecr.calls, cluster.calls]
+    phases = []
+    session = boto3.Session(
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+        region_name=REGION,
+    )
+    create_ecr_client = main.create_ecr_client
+
+    def create_fake_ecr_client(*args, **kwargs):
+        client, client_metrics = create_ecr_client(*args, **kwargs)
+        ecr.attach(client)
+        return client, client_metrics
+
+    policy = main.RetentionPolicy.from_now()
+    settings = main.SweepSettings(
+        policy=policy,
+        policies=main.load_retention_policies(None, policy),
+        scan_concurrency=concurrency,
+        max_pool_connections=max(main.AWS_MAX_POOL_CONNECTIONS, concurrency),
+        delete_unapproved=delete_unapproved,
+    )
+    metrics = main.RunMetrics()
+    if memory:
+        tracemalloc.start()
+    try:
+        with (
+            Phase("workloads", counters, phases, memory),
+            mock.patch.object(main, "get_workload_listers", cluster.listers),
+        ):
+            k8s_images = main.get_images_from_workloads(main.K8S_PAGE_SIZE)
+        with Phase("index", counters, phases, memory):
+            references = main.ImageReferenceIndex(k8s_images)
+            del k8s_images
+        with (
+            Phase("target", counters, phases, memory),
+            mock.patch.object(main, "target_session", lambda target: session),
+            mock.patch.object(main, "create_ecr_client", create_fake_ecr_client),
+        ):
+            report = main.run_target(
+                {"registry_id": REGISTRY_ID, "region": REGION},
+                references,
+                settings,
+                metrics=metrics,
+            )
+    finally:
+        if memory:
+            tracemalloc.stop()
+    breakdown = Counter()
+    evaluated = 0
+    for (name, labels), value in metrics.values.items():
+        if name == "phase_seconds":
+            breakdown[dict(labels)["phase"]] += value
+        elif name == "images_evaluated_total":
+            evaluated += value
+    return {
+        "phases": phases,
+        "breakdown": {phase: round(seconds, 3) for phase, seconds in breakdown.items()},
+        "images_evaluated": int(evaluated),
+        "images_deleted": ecr.deleted,
+        "deletable_images": report["deletable_images"],
+        "api": report["api"],
+        "references": len(references),
+    }
+
+
+def print_results(results: dict) -> None:
+    print(f"{'phase':<20}{'seconds':>10}{'peak MiB':>10}  requests")
+    for phase in results["phases"]:
+        peak = phase["peak_memory_bytes"]
+        peak = f"{peak / 2**20:.1f}" if peak is not None else "-"
+        calls = " ".join(
+            f"{operation}={count}"
+            for operation, count in sorted(phase["calls"].items())
+        )
+        print(f"{phase['phase']:<20}{phase['seconds']:>10.3f}{peak:>10}  {calls}")
+    # Scans run on several workers, so their seconds add up every worker
+    for phase, seconds in results["breakdown"].items():
+        print(f"  {phase:<20}{seconds:>8.3f}")
+    for operation, counters in results["api"].items():
+        print(
+            f"{operation}: "
+            + " ".join(f"{key}={value}" for key, value in counters.items())
+        )
+    print(
+        f"evaluated {results['images_evaluated']} images, deleted {results['images_deleted']}, "
+        f"{results['references']} references"
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repositories", type=int, default=200)
+    parser.add_argument(
+        "--images", type=int, default=200, help="container images per repository"
+    )
+    parser.add_argument(
+        "--signed", type=float, default=0.3, help="fraction of images with a signature"
+    )
+    parser.add_argument("--pods", type=int, default=2000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per API call"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="probability a request is throttled",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="SCAN_CONCURRENCY of the run"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--delete-unapproved",
+        action="store_true",
+        help="read the Approved tags and force deletion, as DELETE_UNAPPROVED_REPOSITORIES",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip tracemalloc, which slows the run down",
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    arguments = parser.parse_args()
+    # The job logs every image at INFO, which would dominate the measurements
+    main.logger.setLevel(logging.WARNING)
+    results = run_benchmark(
+        arguments.repositories,
+        arguments.images,
+        arguments.signed,
+        arguments.pods,
+        arguments.latency,
+        arguments.throttle_rate,
+        arguments.concurrency,
+        arguments.seed,
+        not arguments.no_memory,
+        arguments.delete_unapproved,
+    )
+    if arguments.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
 import boto3
+import cProfile
+import fnmatch
+import hashlib
+import heapq
 import json
 import logging
+import io
 import os
+import pstats
+import random
+import re
+import sqlite3
 import sys
-from collections import defaultdict
-from datetime import datetime, timedelta
-
+import threading
+import time
+import tracemalloc
+import urllib.request
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+
+import botocore.session
 import pytz
-from kubernetes import client, config
+from botocore.config import Config
+from botocore.credentials import (
+    AssumeRoleCredentialFetcher,
+    DeferredRefreshableCredentials,
+)
+from botocore.exceptions import BotoCoreError, ClientError
+from kubernetes import client, config, watch
 
 logger = logging.getLogger("ecr-image-cleanup")
 hdlr = logging.StreamHandler()
@@ -30,6 +53,112 @@ MANIFEST_LIST_MEDIA_TYPES = {
     "application/vnd.oci.image.index.v1+json",
 }
 
+# batch_delete_image accepts at most 100 imageIds per call.
+BATCH_DELETE_LIMIT = 100
+BATCH_DELETE_ATTEMPTS = 3
+# batch_get_image accepts at most 100 imageIds per call.
+BATCH_GET_LIMIT = 100
+
+# Seconds of the first jittered backoff after a batch_delete_image call failed outright.
+DELETE_BACKOFF_BASE = 1.0
+
+# Attempts botocore makes per call, and connections it keeps per client.
+AWS_MAX_ATTEMPTS = 10
+AWS_MAX_POOL_CONNECTIONS = 10
+
+# Prefix, type and help text of every metric a run exports.
+METRIC_PREFIX = "ecr_cleanup_"
+METRIC_DESCRIPTIONS = {
+    "phase_seconds": (
+        "gauge",
+        "Seconds spent in each phase, summed over concurrent workers",
+    ),
+    "api_calls_total": ("counter", "ECR API calls per operation"),
+    "api_retries_total": (
+        "counter",
+        "ECR API attempts retried by botocore per operation",
+    ),
+    "api_throttles_total": ("counter", "Throttled ECR API attempts per operation"),
+    "api_errors_total": (
+        "counter",
+        "Failed ECR API attempts per operation, throttles excluded",
+    ),
+    "repositories": ("gauge", "Repositories found in the registry"),
+    "images_evaluated_total": (
+        "counter",
+        "Container images evaluated against the rules",
+    ),
+    "images_deletable_total": ("counter", "Images and artifacts selected for deletion"),
+    "images_deleted_total": ("counter", "Images and artifacts deleted"),
+    "bytes_deletable_total": (
+        "counter",
+        "imageSizeInBytes of the images selected for deletion",
+    ),
+    "bytes_reclaimed_total": ("counter", "imageSizeInBytes of the images deleted"),
+    "failed_targets": ("gauge", "Targets whose cleanup failed"),
+    "unsynced_informers": (
+        "gauge",
+        "Workload watches out of sync, the controller skips its sweep while any are",
+    ),
+    "last_run_timestamp_seconds": ("gauge", "Time the run finished"),
+}
+
+# Rows of the hot function and allocation site tables of a profile report.
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_TOP_ALLOCATIONS = 20
+
+# Error codes AWS uses when a request was rate limited.
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+}
+
+# Failure codes from batch_delete_image that retrying won't fix.
+PERMANENT_DELETE_FAILURES = {
+    "ImageNotFound",
+    "InvalidImageDigest",
+    "MissingDigestAndTag",
+}
+
+# Column value for a push or pull time ECR has no record of.
+NEVER = -1
+
+# Registry assumed for image references without one, and the hostnames it is known by.
+DOCKER_HUB_REGISTRY = "docker.io"
+DOCKER_HUB_ALIASES = {"docker.io", "index.docker.io", "registry-1.docker.io"}
+
+# Keys leading from the raw JSON of each workload kind to its pod spec.
+WORKLOAD_SPEC_PATHS = {
+    "DaemonSet": ("spec", "template", "spec"),
+    "Deployment": ("spec", "template", "spec"),
+    "StatefulSet": ("spec", "template", "spec"),
+    "CronJob": ("spec", "jobTemplate", "spec", "template", "spec"),
+    "Job": ("spec", "template", "spec"),
+    "Pod": ("spec",),
+}
+
+# Objects requested per Kubernetes list call.
+K8S_PAGE_SIZE = 500
+
+# Seconds a watch stays open before it is reopened from the last resourceVersion.
+WATCH_TIMEOUT = 300
+
+# Seconds between sweeps in controller mode.
+SWEEP_INTERVAL = 3600
+
+# Seconds a cached map of repository tags stays valid.
+TAG_CACHE_TTL = 3600
+
+# Upper bound on entries kept in the on-disk subject cache before LRU eviction.
+SUBJECT_CACHE_MAX_ENTRIES = 1_000_000
+
+# cosign stores signatures, attestations and SBOMs under sha256-<subject hex>.<suffix> tags.
+COSIGN_TAG_PATTERN = re.compile(r"^sha256-(?P<hex>[0-9a-f]{64})\.(sig|att|sbom)$")
+
 # These artifact media types represent standard image config blobs, not ancillary artifacts.
 SAFE_ARTIFACT_MEDIA_TYPES = {
     None,
@@ -38,6 +167,404 @@ SAFE_ARTIFACT_MEDIA_TYPES = {
 }
 
 
+class TokenBucket:
+    """
+    Thread safe token bucket that refills at rate tokens per second up to capacity.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float | None = None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available.
+        :return waited float: seconds spent waiting
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Taking the token up front queues later callers behind this one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class ClientMetrics:
+    """
+    Per operation counters of the calls, attempts, throttles and errors of a boto3 client,
+    fed by botocore events.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.attempts = Counter()
+        self.throttles = Counter()
+        self.errors = Counter()
+        self.throttle_wait = Counter()
+        self.lock = threading.Lock()
+
+    def record_call(self, operation: str, waited: float = 0.0):
+        with self.lock:
+            self.calls[operation] += 1
+            self.throttle_wait[operation] += waited
+
+    def record_attempt(self, operation: str, error_code: str | None):
+        with self.lock:
+            self.attempts[operation] += 1
+            if error_code in THROTTLING_ERROR_CODES:
+                self.throttles[operation] += 1
+            elif error_code:
+                self.errors[operation] += 1
+
+    def retries(self, operation: str) -> int:
+        return max(0, self.attempts[operation] - self.calls[operation])
+
+    def summary(self) -> dict:
+        """
+        :return summary dict: operation mapped to its counters
+        """
+        with self.lock:
+            return {
+                operation: {
+                    "calls": self.calls[operation],
+                    "retries": self.retries(operation),
+                    "throttles": self.throttles[operation],
+                    "errors": self.errors[operation],
+                    "throttle_wait": round(self.throttle_wait[operation], 3),
+                }
+                for operation in sorted(self.calls)
+            }
+
+
+def parse_rate_limits(value: str | None) -> dict:
+    """
+    :param value str: JSON object of operation name to requests per second,
+        e.g. {"DescribeImages": 20, "BatchDeleteImage": 5}
+    :return rate_limits dict:
+    """
+    if not value:
+        return {}
+    rate_limits = {
+        operation: float(rate) for operation, rate in json.loads(value).items()
+    }
+    for operation, rate in rate_limits.items():
+        # A bucket without refill would wait forever (or divide by zero)
+        if not rate > 0:
+            raise ValueError(f"Rate limit of {operation} must be positive, not {rate}")
+    return rate_limits
+
+
+def instrument_client(
+    client, rate_limits: dict | None = None, metrics: ClientMetrics | None = None
+):
+    """
+    :param client boto3.client:
+    :param rate_limits dict: operation name mapped to requests per second
+    :param metrics ClientMetrics: counters to update, a new one if not given
+
+    Hooks the client's before-call event to take a token from the bucket of the operation
+    and its needs-retry event, which fires after every attempt, to count throttles and
+    retries. Retrying itself is left to botocore's retry mode.
+    :return metrics ClientMetrics:
+    """
+    metrics = metrics or ClientMetrics()
+    buckets = {
+        operation: TokenBucket(rate) for operation, rate in (rate_limits or {}).items()
+    }
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def before_call(model, **kwargs):
+        bucket = buckets.get(model.name)
+        metrics.record_call(model.name, bucket.acquire() if bucket else 0.0)
+
+    def needs_retry(operation, response=None, caught_exception=None, **kwargs):
+        error_code = None
+        if response is not None:
+            error_code = response[1].get("Error", {}).get("Code")
+        elif caught_exception is not None:
+            error_code = type(caught_exception).__name__
+        metrics.record_attempt(operation.name, error_code)
+
+    client.meta.events.register(f"before-call.{service}", before_call)
+    client.meta.events.register(f"needs-retry.{service}", needs_retry)
+    return metrics
+
+
+def create_ecr_client(
+    max_pool_connections: int = AWS_MAX_POOL_CONNECTIONS,
+    max_attempts: int = AWS_MAX_ATTEMPTS,
+    rate_limits: dict | None = None,
+    metrics: ClientMetrics | None = None,
+    session: boto3.Session | None = None,
+):  # pragma: no cover
+    """
+    :param max_pool_connections int: connections kept by the client, one per concurrent worker
+    :param max_attempts int: attempts per call, including the first
+    :param rate_limits dict: operation name mapped to requests per second
+    :param metrics ClientMetrics: counters to update
+    :param session boto3.Session: session of the target account and region, the default one if not given
+    Creates the ECR client shared by every worker. Adaptive retry mode backs off with
+    jitter and slows the client down when ECR starts throttling.
+    :return client boto3.client, metrics ClientMetrics:
+    """
+    ecr_client = (session or boto3).client(
+        "ecr",
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={"mode": "adaptive", "total_max_attempts": max_attempts},
+        ),
+    )
+    return ecr_client, instrument_client(ecr_client, rate_limits, metrics)
+
+
+def log_client_metrics(metrics: ClientMetrics):
+    for operation, counters in metrics.summary().items():
+        logger.info(
+            f"ECR {operation}: "
+            + " ".join(f"{key}={value}" for key, value in counters.items())
+        )
+
+
+class Profiler:
+    """
+    Profiles phases of a run with cProfile and compares tracemalloc snapshots taken around
+    them, then writes one report per run. cProfile only sees the thread it is enabled on,
+    so work done on a pool is profiled inside each worker call, and only one call is
+    profiled at a time: with several workers the tables are a sample of the calls. Those
+    calls skip the snapshots, which are taken around the whole phase instead. tracemalloc
+    sees every thread, so phases running at the same time share their allocations.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.started = time.strftime("%Y%m%dT%H%M%S")
+        self.profiles = defaultdict(list)
+        self.allocations = defaultdict(list)
+        self.durations = Counter()
+        self.calls = Counter()
+        self.profiled = Counter()
+        self.lock = threading.Lock()
+        # cProfile can't run in two threads at once on newer Pythons
+        self.profiling = threading.Lock()
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name: str, functions: bool = True, allocations: bool = True):
+        """
+        :param name str: phase the call is reported under
+        :param functions bool: whether to profile the call with cProfile
+        :param allocations bool: whether to compare tracemalloc snapshots around the call
+        """
+        profile = None
+        if functions and self.profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+        before = tracemalloc.take_snapshot() if allocations else None
+        started = time.monotonic()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self.profiling.release()
+            elapsed = time.monotonic() - started
+            grown = []
+            if before is not None:
+                grown = tracemalloc.take_snapshot().compare_to(before, "lineno")
+            with self.lock:
+                self.durations[name] += elapsed
+                self.calls[name] += 1
+                if profile:
+                    self.profiled[name] += 1
+                    self.profiles[name].append(profile)
+                if before is not None:
+                    self.allocations[name].extend(grown[:PROFILE_TOP_ALLOCATIONS])
+
+    def report(self) -> str:
+        """
+        :return report str: per phase hot functions by cumulative and own time, and the
+        allocation sites that grew the most
+        """
+        out = io.StringIO()
+        with self.lock:
+            for name, duration in self.durations.items():
+                out.write(
+                    f"=== {name}: {duration:.3f}s in {self.calls[name]} calls, "
+                    f"{self.profiled[name]} profiled\n"
+                )
+                if self.profiles[name]:
+                    stats = pstats.Stats(*self.profiles[name], stream=out)
+                    for order in ("cumulative", "tottime"):
+                        out.write(f"\n--- hot functions by {order}\n")
+                        stats.sort_stats(order).print_stats(PROFILE_TOP_FUNCTIONS)
+                if name in self.allocations:
+                    out.write("\n--- top allocation sites\n")
+                    for allocation in sorted(
+                        self.allocations[name], key=lambda a: a.size_diff, reverse=True
+                    )[:PROFILE_TOP_ALLOCATIONS]:
+                        out.write(f"{allocation}\n")
+                out.write("\n")
+        return out.getvalue()
+
+    def write_report(self) -> str:
+        """
+        Writes the report, and the raw stats of every phase for tools such as snakeviz.
+        :return path str: path of the report
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"profile-{self.started}")
+        with self.lock:
+            for name, profiles in self.profiles.items():
+                pstats.Stats(*profiles).dump_stats(f"{prefix}-{name}.pstats")
+        with open(f"{prefix}.txt", "w") as f:
+            f.write(self.report())
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        logger.info(f"Wrote the profile of the run to {prefix}.txt")
+        return f"{prefix}.txt"
+
+
+class RunMetrics:
+    """
+    Metrics of a run, keyed by name and labels, rendered in the Prometheus text exposition
+    format once the run is over. Phases that run on several workers at once add up the
+    time of every worker.
+    """
+
+    def __init__(self, profiler: Profiler | None = None):
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        self.profiler = profiler
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def phase(self, name: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.inc("phase_seconds", time.monotonic() - started, phase=name, **labels)
+
+    @contextmanager
+    def profile(self, name: str, functions: bool = True, allocations: bool = True):
+        # cProfile runs once at a time, so a nested call only profiles functions if the
+        # enclosing one doesn't
+        if self.profiler is None:
+            yield
+            return
+        with self.profiler.phase(name, functions, allocations):
+            yield
+
+    def add_client_metrics(self, client_metrics: ClientMetrics, **labels) -> None:
+        for operation, counters in client_metrics.summary().items():
+            for key in ("calls", "retries", "throttles", "errors"):
+                self.inc(
+                    f"api_{key}_total", counters[key], operation=operation, **labels
+                )
+
+    def render(self) -> str:
+        """
+        :return text str: every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            metric = f"{METRIC_PREFIX}{name}"
+            if name not in described:
+                metric_type, description = METRIC_DESCRIPTIONS[name]
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} {metric_type}")
+                described.add(name)
+            if labels:
+                label_text = ",".join(
+                    f'{key}="{escape_label_value(str(label))}"' for key, label in labels
+                )
+                metric = f"{metric}{{{label_text}}}"
+            lines.append(f"{metric} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_metrics_textfile(path: str, text: str) -> None:
+    """
+    :param path str: file read by the node exporter textfile collector
+    :param text str: rendered metrics
+    The file is replaced atomically so the collector never reads half of it.
+    """
+    with open(f"{path}.tmp", "w") as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+
+
+def push_metrics(
+    url: str, text: str, job: str = "ecr-cleanup"
+) -> None:  # pragma: no cover
+    """
+    :param url str: base URL of a Pushgateway compatible endpoint
+    :param text str: rendered metrics
+    :param job str: job label the metrics are grouped under
+    """
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/metrics/job/{job}",
+        data=text.encode(),
+        method="PUT",
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def emit_metrics(metrics: RunMetrics) -> None:  # pragma: no cover
+    """
+    Writes the metrics to METRICS_TEXTFILE and pushes them to PUSHGATEWAY_URL when set.
+    Failing to export metrics doesn't fail the run.
+    """
+    text = metrics.render()
+    try:
+        if os.getenv("METRICS_TEXTFILE"):
+            write_metrics_textfile(os.getenv("METRICS_TEXTFILE"), text)
+        if os.getenv("PUSHGATEWAY_URL"):
+            push_metrics(
+                os.getenv("PUSHGATEWAY_URL"),
+                text,
+                os.getenv("PUSHGATEWAY_JOB", "ecr-cleanup"),
+            )
+    except OSError as e:
+        logger.error(f"Unable to export metrics: {e}")
+
+
 def is_container_manifest(image: dict) -> bool:
     """
     Determine whether the ECR entry is an actual runnable container manifest.
@@ -83,434 +610,2408 @@ def extract_subject_digest(manifest_body: str) -> str | None:
     return None
 
 
-def get_artifact_subject_digest(
+def subject_digest_from_tags(tags: list) -> str | None:
+    """
+    :param tags list: tags of an artifact
+
+    Derives the subject digest from cosign's sha256-<digest>.sig/.att/.sbom tag convention.
+    :return subject_digest str: the subject digest or None when no tag follows the convention
+    """
+    for tag in tags:
+        match = COSIGN_TAG_PATTERN.match(tag)
+        if match:
+            return f"sha256:{match['hex']}"
+    return None
+
+
+def chunk(items: list, size: int) -> list:
+    """
+    :param items list: items to split
+    :param size int: maximum length of each chunk
+
+    :return chunks list: the items split into lists no longer than size
+    """
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def get_artifact_subject_digests(
     client: boto3.client,
     registry_id: str,
     repository: dict,
-    image: dict,
-) -> str | None:
+    artifacts: list,
+) -> dict:
     """
-    Retrieve the subject digest for an artifact manifest so we can associate it with its image.
+    Retrieve the subject digests for artifact manifests so we can associate them with their image.
+    Artifacts are grouped by media type and fetched in batch_get_image calls of up to
+    BATCH_GET_LIMIT digests.
+    :return subject_digests dict: artifact digest mapped to its subject digest, or None when
+    the manifest was fetched but has no subject
     """
-    media_type = image.get("imageManifestMediaType")
-    if not media_type:
-        return None
+    by_media_type = defaultdict(list)
+    for artifact in artifacts:
+        media_type = artifact.get("imageManifestMediaType")
+        if media_type:
+            by_media_type[media_type].append(artifact["imageDigest"])
+
+    subject_digests = {}
+    for media_type, digests in by_media_type.items():
+        for batch in chunk(digests, BATCH_GET_LIMIT):
+            try:
+                response = client.batch_get_image(
+                    registryId=registry_id,
+                    repositoryName=repository["repository_name"],
+                    imageIds=[{"imageDigest": digest} for digest in batch],
+                    acceptedMediaTypes=[media_type],
+                )
+            except client.exceptions.ImageNotFoundException:
+                logger.warning("Artifacts %s no longer exist", batch)
+                continue
+
+            for failure in response.get("failures", []):
+                logger.warning(
+                    "Unable to fetch artifact %s: %s %s",
+                    failure.get("imageId", {}).get("imageDigest"),
+                    failure.get("failureCode"),
+                    failure.get("failureReason"),
+                )
 
-    try:
-        response = client.batch_get_image(
-            registryId=registry_id,
-            repositoryName=repository["repository_name"],
-            imageIds=[{"imageDigest": image["imageDigest"]}],
-            acceptedMediaTypes=[media_type],
+            for image in response.get("images", []):
+                digest = image.get("imageId", {}).get("imageDigest")
+                manifest_body = image.get("imageManifest")
+                if not manifest_body:
+                    logger.debug("Artifact manifest missing for %s", digest)
+                    continue
+                subject_digest = extract_subject_digest(manifest_body)
+                # Keep manifests without a subject too, so callers can remember the miss
+                subject_digests[digest] = subject_digest
+                if not subject_digest:
+                    logger.debug("Artifact %s manifest has no subject digest", digest)
+    return subject_digests
+
+
+class SubjectCache:
+    """
+    On-disk SQLite cache of artifact subject digests keyed by (repository, digest).
+
+    Digests are content addressed so an entry never goes stale, it only stops being useful
+    once the artifact is deleted. Entries are pruned when a repository scan no longer sees
+    them and the least recently used entries are evicted once max_entries is exceeded.
+    """
+
+    def __init__(self, path: str, max_entries: int = SUBJECT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS subjects (
+                    repository TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    subject TEXT,
+                    media_type TEXT,
+                    last_used INTEGER NOT NULL,
+                    PRIMARY KEY (repository, digest)
+                ) WITHOUT ROWID
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS subjects_last_used ON subjects (last_used)"
+            )
+
+    def get_many(self, repository: str, digests: list) -> dict:
+        """
+        :return entries dict: digest mapped to its cached subject digest (which may be None)
+        """
+        entries = {}
+        now = int(time.time())
+        with self._lock, self._connection:
+            # stay well below SQLite's bound parameter limit
+            for batch in chunk(digests, 500):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT digest, subject FROM subjects WHERE repository = ? AND digest IN ({placeholders})",
+                    [repository, *batch],
+                ).fetchall()
+                entries.update(rows)
+                self._connection.executemany(
+                    "UPDATE subjects SET last_used = ? WHERE repository = ? AND digest = ?",
+                    [(now, repository, digest) for digest, _ in rows],
+                )
+        return entries
+
+    def put_many(self, repository: str, entries: dict, media_types: dict) -> None:
+        """
+        :param entries dict: digest mapped to its subject digest (or None)
+        :param media_types dict: digest mapped to its manifest media type
+        """
+        now = int(time.time())
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO subjects VALUES (?, ?, ?, ?, ?)",
+                [
+                    (repository, digest, subject, media_types.get(digest), now)
+                    for digest, subject in entries.items()
+                ],
+            )
+
+    def prune(self, repository: str, live_digests: set) -> int:
+        """
+        Removes entries for digests that are no longer in the repository.
+        :return removed int: number of entries removed
+        """
+        with self._lock, self._connection:
+            cached = self._connection.execute(
+                "SELECT digest FROM subjects WHERE repository = ?", (repository,)
+            ).fetchall()
+            stale = [
+                (repository, digest)
+                for (digest,) in cached
+                if digest not in live_digests
+            ]
+            self._connection.executemany(
+                "DELETE FROM subjects WHERE repository = ? AND digest = ?", stale
+            )
+        return len(stale)
+
+    def evict(self) -> int:
+        """
+        Drops the least recently used entries beyond max_entries.
+        :return removed int: number of entries removed
+        """
+        with self._lock, self._connection:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM subjects"
+            ).fetchone()
+            excess = count - self.max_entries
+            if excess <= 0:
+                return 0
+            self._connection.execute(
+                """
+                DELETE FROM subjects WHERE (repository, digest) IN (
+                    SELECT repository, digest FROM subjects ORDER BY last_used LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+        return excess
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def resolve_artifact_subjects(
+    client: boto3.client,
+    registry_id: str,
+    repository: dict,
+    artifacts: list,
+    cache: SubjectCache | None = None,
+) -> tuple[dict, Counter]:
+    """
+    Resolves subject digests from well-known tags first, then from the subject cache, and
+    only fetches manifests for the artifacts neither of them knows about.
+    :return subject_digests dict, stats Counter: subjects by artifact digest and hit/miss counts
+    """
+    subject_digests = {}
+    unresolved = []
+    for artifact in artifacts:
+        subject_digest = subject_digest_from_tags(artifact.get("imageTags", []))
+        if subject_digest:
+            subject_digests[artifact["imageDigest"]] = subject_digest
+        else:
+            unresolved.append(artifact)
+
+    stats = Counter(
+        subject_tag_hits=len(artifacts) - len(unresolved),
+        subject_tag_misses=len(unresolved),
+    )
+    if unresolved and cache:
+        cached = cache.get_many(
+            repository["repository_name"],
+            [artifact["imageDigest"] for artifact in unresolved],
         )
-    except client.exceptions.ImageNotFoundException:
-        logger.warning("Artifact %s no longer exists", image.get("imageDigest"))
-        return None
+        subject_digests.update(cached)
+        unresolved = [
+            artifact for artifact in unresolved if artifact["imageDigest"] not in cached
+        ]
+        stats["subject_cache_hits"] += len(cached)
+    if unresolved:
+        fetched = get_artifact_subject_digests(
+            client, registry_id, repository, unresolved
+        )
+        stats["subject_manifest_fetches"] += len(unresolved)
+        subject_digests.update(fetched)
+        if cache:
+            cache.put_many(
+                repository["repository_name"],
+                fetched,
+                {
+                    artifact["imageDigest"]: artifact.get("imageManifestMediaType")
+                    for artifact in unresolved
+                },
+            )
+    return subject_digests, stats
 
-    images = response.get("images", [])
-    if not images:
-        logger.debug("No artifact data returned for %s", image.get("imageDigest"))
-        return None
 
-    manifest_body = images[0].get("imageManifest")
-    if not manifest_body:
-        logger.debug("Artifact manifest missing for %s", image.get("imageDigest"))
-        return None
+def epoch_seconds(timestamp: datetime | None) -> int | None:
+    return int(timestamp.timestamp()) if timestamp else None
 
-    subject_digest = extract_subject_digest(manifest_body)
-    if not subject_digest:
-        logger.debug(
-            "Artifact %s manifest has no subject digest", image.get("imageDigest")
+
+@dataclass(slots=True)
+class ImageRecord:
+    """
+    Compact view of a describe_images entry holding only what the rules and the deletion
+    read. Timestamps are epoch seconds, media types are interned and every record of a
+    repository shares the same repository dict instead of carrying its own URI string.
+    """
+
+    repository: dict = field(repr=False)
+    digest: str
+    tags: tuple = ()
+    pushed_at: int | None = None
+    pulled_at: int | None = None
+    manifest_media_type: str | None = None
+    artifact_media_type: str | None = None
+    subject_digest: str | None = None
+    size: int | None = None
+
+    @classmethod
+    def from_image(cls, image: dict, repository: dict) -> "ImageRecord":
+        """
+        :param image dict: image details from describe_images
+        :param repository dict: repository the image belongs to, shared by all of its records
+        """
+        manifest_media_type = image.get("imageManifestMediaType")
+        artifact_media_type = image.get("artifactMediaType")
+        return cls(
+            repository=repository,
+            digest=image["imageDigest"],
+            tags=tuple(image.get("imageTags", ())),
+            pushed_at=epoch_seconds(image.get("imagePushedAt")),
+            pulled_at=epoch_seconds(image.get("lastRecordedPullTime")),
+            manifest_media_type=sys.intern(manifest_media_type)
+            if manifest_media_type
+            else None,
+            artifact_media_type=sys.intern(artifact_media_type)
+            if artifact_media_type
+            else None,
+            size=image.get("imageSizeInBytes"),
         )
-    return subject_digest
 
+    @property
+    def registry_id(self) -> str:
+        return self.repository["registry_id"]
+
+    @property
+    def repository_name(self) -> str:
+        return self.repository["repository_name"]
+
+    @property
+    def force_delete(self) -> bool:
+        return bool(self.repository.get("delete"))
+
+    @property
+    def image_uri(self) -> str:
+        # First tag, otherwise the digest
+        if self.tags:
+            return f"{self.repository['repository_uri']}:{self.tags[0]}"
+        if self.digest:
+            return f"{self.repository['repository_uri']}@{self.digest}"
+        return self.repository["repository_uri"]
+
+
+# Tags that protect an image when a policy doesn't name its own
+KEEP_TAG_PATTERN = re.compile(r"^keep$")
+RETENTION_POLICY_KEYS = {
+    "push_window_days",
+    "pull_window_days",
+    "protect_tags",
+    "keep_last",
+    "keep_last_by",
+    "keep_last_prefixes",
+}
+RETENTION_RULE_PATTERN_KEYS = {"match", "regex"}
+# Numbered backreferences, named groups and conditionals only keep their meaning on their own
+UNCOMBINABLE_PATTERN_SYNTAX = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(")
+KEEP_LAST_ORDERS = {"pushed", "semver"}
+SEMVER_PATTERN = re.compile(
+    r"v?(?P<major>0|[1-9][0-9]*)\.(?P<minor>0|[1-9][0-9]*)\.(?P<patch>0|[1-9][0-9]*)"
+    r"(?:-(?P<prerelease>[0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class RetentionPolicy:
+    """
+    How long pushes and pulls protect an image, measured from a reference time fixed when
+    the policy is built. One policy is built per run and passed to every rule, so every
+    image is judged against the same clock.
+    """
+
+    reference_time: int
+    push_window_days: int = 7
+    pull_window_days: int = 7
+    protect_tags: re.Pattern = KEEP_TAG_PATTERN
+    keep_last: int = 0
+    keep_last_by: str = "pushed"
+    keep_last_prefixes: tuple = ()
+
+    @classmethod
+    def from_now(
+        cls, push_window_days: int = 7, pull_window_days: int = 7
+    ) -> "RetentionPolicy":
+        return cls(int(time.time()), push_window_days, pull_window_days)
+
+    @property
+    def push_cutoff(self) -> int:
+        # Pushes after this epoch second keep an image
+        return self.reference_time - self.push_window_days * 86400
+
+    @property
+    def pull_cutoff(self) -> int:
+        # Pulls after this epoch second keep an image
+        return self.reference_time - self.pull_window_days * 86400
+
+    def protects(self, tags) -> bool:
+        """
+        :param tags tuple: tags of an image
+        :return bool: True if any tag matches one of the protected tag patterns
+        """
+        return any(self.protect_tags.search(tag) for tag in tags)
+
+
+def is_combinable_pattern(pattern: str) -> bool:
+    """
+    :param pattern str: regular expression that compiles on its own
+    :return bool: True if the pattern keeps its meaning inside a larger alternation
 
-def build_image_uri(image: dict, repository: dict) -> dict:
-    logger.debug(image)
-    logger.debug(
-        "Only include actual container images not .sig files which are a different mediaType"
+    Global inline flags are only valid at the start of a whole expression, numbered
+    backreferences shift with the groups in front of them and group names must be unique,
+    so patterns using any of them are matched on their own instead.
+    """
+    return not (
+        re.compile(pattern).flags & ~re.UNICODE
+        or UNCOMBINABLE_PATTERN_SYNTAX.search(pattern)
     )
-    if is_container_manifest(image):
-        if "imageTags" in image:
-            image["image_uri"] = (
-                f"{repository['repository_uri']}:{image['imageTags'][0]}"
+
+
+def compile_pattern(pattern, setting: str) -> re.Pattern:
+    """
+    :param pattern str: regular expression from the retention policy file
+    :param setting str: name of the setting, for the error message
+    :return pattern re.Pattern:
+    """
+    if not isinstance(pattern, str):
+        raise ValueError(f"{setting} must be a regular expression, not {pattern!r}")
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid {setting} pattern {pattern!r}: {e}") from e
+
+
+def compile_tag_patterns(patterns: list) -> re.Pattern:
+    """
+    :param patterns list: regular expressions of protected tags
+    :return pattern re.Pattern: a single pattern matching any of them
+    """
+    for pattern in patterns:
+        compile_pattern(pattern, "protect_tags")
+        if len(patterns) > 1 and not is_combinable_pattern(pattern):
+            raise ValueError(
+                f"protect_tags pattern {pattern!r} can't be combined with other patterns, "
+                "use scoped flags such as (?i:...) and no backreferences or named groups"
             )
-        else:
-            image["image_uri"] = (
-                f"{repository['repository_uri']}@{image['imageDigest']}"
+    if len(patterns) == 1:
+        return re.compile(patterns[0])
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns) or "(?!)")
+
+
+def is_count(value) -> bool:
+    """
+    :param value: setting from the retention policy file
+    :return bool: True for a non-negative integer, JSON booleans excluded
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def policy_from_rule(
+    rule: dict, base: RetentionPolicy, pattern_keys: set = frozenset()
+) -> RetentionPolicy:
+    """
+    :param rule dict: one entry of the retention policy file
+    :param base RetentionPolicy: policy supplying the reference time and any unset setting
+    :param pattern_keys set: keys naming the repositories of the rule, allowed besides the settings
+    :return policy RetentionPolicy:
+    """
+    if not isinstance(rule, dict):
+        raise ValueError(f"Retention policy rule {rule!r} is not an object")
+    unknown = rule.keys() - RETENTION_POLICY_KEYS - pattern_keys
+    if unknown:
+        raise ValueError(
+            f"Unknown retention policy settings {sorted(unknown)} in {rule}"
+        )
+    settings = {key: rule[key] for key in RETENTION_POLICY_KEYS if key in rule}
+    for key in ("push_window_days", "pull_window_days", "keep_last"):
+        if key in settings and not is_count(settings[key]):
+            raise ValueError(
+                f"{key} must be a non-negative integer, not {settings[key]!r}"
             )
-        return image
-    else:
-        return None
+    for key in ("protect_tags", "keep_last_prefixes"):
+        if key in settings and not (
+            isinstance(settings[key], list)
+            and all(isinstance(value, str) for value in settings[key])
+        ):
+            raise ValueError(f"{key} must be a list of strings, not {settings[key]!r}")
+    if "protect_tags" in settings:
+        settings["protect_tags"] = compile_tag_patterns(settings["protect_tags"])
+    if "keep_last_prefixes" in settings:
+        settings["keep_last_prefixes"] = tuple(settings["keep_last_prefixes"])
+    if settings.get("keep_last_by", "pushed") not in KEEP_LAST_ORDERS:
+        raise ValueError(
+            f"keep_last_by must be one of {sorted(KEEP_LAST_ORDERS)}, not {settings['keep_last_by']}"
+        )
+    return replace(base, **settings)
 
 
-def append_image(images: list, imageDetails: list, repository: dict) -> list:
-    for image in imageDetails:
-        image = build_image_uri(image, repository)
-        if image:
-            images.append(image)
+class RetentionPolicyMatcher:
+    """
+    Assigns a RetentionPolicy to repositories by name. Consecutive repository patterns are
+    compiled into one regular expression with a named group per rule, so finding the policy
+    of a repository is a single match however many rules there are. Patterns that can't be
+    combined are matched on their own between those groups. The first rule that matches
+    wins and results are memoized per repository name.
+    """
+
+    def __init__(self, rules: list, default: RetentionPolicy):
+        """
+        :param rules list: (regular expression, RetentionPolicy) pairs in priority order
+        :param default RetentionPolicy: policy of repositories no rule matches
+        """
+        self.default = default
+        self._rules = len(rules)
+        # (pattern, policies by group name) for combined rules, (pattern, policy) otherwise
+        self._segments = []
+        combined = []
+        for i, (pattern, policy) in enumerate(rules):
+            if is_combinable_pattern(pattern):
+                combined.append((f"rule{i}", pattern, policy))
+                continue
+            self._add_combined(combined)
+            combined = []
+            self._segments.append((re.compile(pattern), policy))
+        self._add_combined(combined)
+        self._cache = {}
+
+    def _add_combined(self, rules: list):
+        """
+        :param rules list: (group name, regular expression, RetentionPolicy) triples
+        """
+        if rules:
+            pattern = re.compile(
+                "|".join(f"(?P<{name}>{pattern})" for name, pattern, _ in rules)
+            )
+            self._segments.append(
+                (pattern, {name: policy for name, _, policy in rules})
+            )
+
+    def __len__(self) -> int:
+        return self._rules
+
+    def policy_for(self, repository_name: str) -> RetentionPolicy:
+        """
+        :param repository_name str:
+        :return policy RetentionPolicy: policy of the first rule matching the repository
+        """
+        try:
+            return self._cache[repository_name]
+        except KeyError:
+            pass
+        policy = self.default
+        for pattern, policies in self._segments:
+            match = pattern.fullmatch(repository_name)
+            if match:
+                # The outer group of a rule closes last, so it is always the last group
+                policy = (
+                    policies[match.lastgroup]
+                    if isinstance(policies, dict)
+                    else policies
+                )
+                break
+        self._cache[repository_name] = policy
+        return policy
+
+
+def load_retention_policies(
+    path: str | None, base: RetentionPolicy
+) -> RetentionPolicyMatcher:
+    """
+    :param path str: JSON retention policy file, None for the base policy everywhere
+    :param base RetentionPolicy: policy built from the environment
+
+    The file holds an optional "default" rule and a list of "repositories" rules. Each
+    repository rule names its repositories with a glob in "match" or a regular expression
+    in "regex" and may set push_window_days, pull_window_days, protect_tags and keep_last.
+    Every rule is validated here, so a mistake fails the run before anything is deleted.
+    :return matcher RetentionPolicyMatcher:
+    """
+    if not path:
+        return RetentionPolicyMatcher([], base)
+    with open(path) as f:
+        document = json.load(f)
+    if not isinstance(document, dict) or document.keys() - {"default", "repositories"}:
+        raise ValueError(
+            f"Retention policy file {path} must be an object with default and repositories"
+        )
+    default = policy_from_rule(document.get("default", {}), base)
+    repositories = document.get("repositories", [])
+    if not isinstance(repositories, list):
+        raise ValueError(f"repositories in {path} must be a list of rules")
+    rules = []
+    for rule in repositories:
+        policy = policy_from_rule(rule, default, RETENTION_RULE_PATTERN_KEYS)
+        if len(rule.keys() & RETENTION_RULE_PATTERN_KEYS) != 1:
+            raise ValueError(
+                f"Retention policy rule {rule} needs exactly one of match or regex"
+            )
+        if "match" in rule:
+            if not isinstance(rule["match"], str):
+                raise ValueError(f"match must be a glob, not {rule['match']!r}")
+            # fnmatch.translate anchors the end itself, fullmatch anchors the start
+            pattern = fnmatch.translate(rule["match"])
+        else:
+            pattern = rule["regex"]
+            compile_pattern(pattern, "regex")
+        rules.append((pattern, policy))
+    logger.info(f"Loaded {len(rules)} retention policy rules from {path}")
+    return RetentionPolicyMatcher(rules, default)
 
+
+def extract_pod_spec_images(pod_spec: dict) -> set:
+    """
+    :param pod_spec dict: raw JSON pod spec
+    :return images set: images of the init containers and containers in the spec
+    """
+    images = set()
+    for key in ("initContainers", "containers"):
+        for container in pod_spec.get(key) or []:
+            if container.get("image"):
+                images.add(container["image"])
     return images
 
 
-def get_images_from_workloads() -> list:  # pragma: no cover
+def extract_pod_status_images(pod_status: dict) -> set:
+    """
+    :param pod_status dict: raw JSON pod status
+
+    The imageID of a container status is the digest the container actually runs, even
+    when the tag in its spec has since been moved to another image. Runtimes report it as
+    docker-pullable://repo@sha256:..., repo@sha256:... or a bare local image id, which
+    names no repository and is skipped.
+    :return images set: repo@digest references of the init containers and containers
+    """
+    images = set()
+    for key in ("initContainerStatuses", "containerStatuses"):
+        for container_status in pod_status.get(key) or []:
+            image_id = container_status.get("imageID") or ""
+            image_id = image_id.removeprefix("docker-pullable://")
+            if "@" in image_id:
+                images.add(image_id)
+    return images
+
+
+def iter_list_pages(list_function, page_size: int):
+    """
+    :param list_function: a list_*_for_all_namespaces function of the kubernetes client
+    :param page_size int: number of objects requested per page
+
+    Follows the continue token of a list call and yields each page as raw JSON. The
+    response is not deserialized into V1 models, so only one page is held at a time.
+    :return pages generator: the raw JSON of every page
+    """
+    continue_token = None
+    while True:
+        kwargs = {"limit": page_size, "_preload_content": False}
+        if continue_token:
+            kwargs["_continue"] = continue_token
+        page = json.loads(list_function(**kwargs).data)
+        yield page
+        continue_token = page.get("metadata", {}).get("continue")
+        if not continue_token:
+            break
+
+
+def extract_item_images(item: dict, spec_path: tuple) -> set:
+    """
+    :param item dict: raw JSON of a workload object
+    :param spec_path tuple: keys leading from the object to its pod spec
+    :return images set: images in the pod spec and, for pods, the digests they run
+    """
+    pod_spec = item
+    for key in spec_path:
+        pod_spec = pod_spec.get(key) or {}
+    # Only pods have container statuses, other kinds contribute nothing here
+    return extract_pod_spec_images(pod_spec) | extract_pod_status_images(
+        item.get("status") or {}
+    )
+
+
+def list_workload_images(list_function, spec_path: tuple, page_size: int) -> set:
+    """
+    :param list_function: a list_*_for_all_namespaces function of the kubernetes client
+    :param spec_path tuple: keys leading from an object to its pod spec
+    :param page_size int: number of objects requested per page
+    :return images set: every image referenced by the listed objects
+    """
+    images = set()
+    for page in iter_list_pages(list_function, page_size):
+        for item in page.get("items") or []:
+            images |= extract_item_images(item, spec_path)
+    return images
+
+
+def get_workload_listers(api_client=None) -> dict:  # pragma: no cover
+    """
+    :param api_client kubernetes.client.ApiClient: cluster to list from, defaults to the loaded config
+    :return listers dict: workload kind mapped to its list_*_for_all_namespaces function
+    """
+    v1 = client.CoreV1Api(api_client)
+    api = client.AppsV1Api(api_client)
+    batch = client.BatchV1Api(api_client)
+    return {
+        "DaemonSet": api.list_daemon_set_for_all_namespaces,
+        "Deployment": api.list_deployment_for_all_namespaces,
+        "StatefulSet": api.list_stateful_set_for_all_namespaces,
+        "CronJob": batch.list_cron_job_for_all_namespaces,
+        "Job": batch.list_job_for_all_namespaces,
+        "Pod": v1.list_pod_for_all_namespaces,
+    }
+
+
+def get_images_from_workloads(
+    page_size: int = K8S_PAGE_SIZE, api_client=None, metrics: RunMetrics | None = None
+) -> list:
     """
     Gets every single pod, deployment, cronjob, etc and gets the image from them.
+    The workload kinds are listed concurrently and merged as each one finishes.
+    :param page_size int: number of objects requested per list call
+    :param api_client kubernetes.client.ApiClient: cluster to list from, defaults to the loaded config
+    :param metrics RunMetrics: metrics of the run, profiles the listing on the worker running it
     :return images list:
     """
+    metrics = metrics or RunMetrics()
+
+    def list_kind(kind: str, list_function) -> tuple[set, float]:
+        logger.info(f"Getting {kind}s from the K8s API")
+        started = time.monotonic()
+        with metrics.profile("workload_listing", allocations=False):
+            images = list_workload_images(
+                list_function, WORKLOAD_SPEC_PATHS[kind], page_size
+            )
+        return images, time.monotonic() - started
+
+    k8s_images = set()
+    listers = get_workload_listers(api_client)
+    with ThreadPoolExecutor(max_workers=len(listers)) as executor:
+        futures = {
+            executor.submit(list_kind, kind, list_function): kind
+            for kind, list_function in listers.items()
+        }
+        for future in as_completed(futures):
+            images, duration = future.result()
+            logger.info(
+                f"Listed {len(images)} images from {futures[future]}s in {duration:.2f}s"
+            )
+            k8s_images |= images
 
-    k8s_images = []
+    return list(k8s_images)
 
-    def parse_images(workload: dict, images: list) -> list:
-        # Throw away function that allows us to check for all images in a workload
-        spec = workload.spec.template.spec
-        if spec.init_containers:
-            for container in spec.init_containers:
-                image = container.image
-                images.append(container.image)
 
-        for container in spec.containers:
-            image = container.image
-            images.append(image)
-        return images
+def get_images_from_clusters(
+    contexts: list, page_size: int = K8S_PAGE_SIZE, metrics: RunMetrics | None = None
+) -> list:
+    """
+    :param contexts list: kubeconfig contexts of every cluster that pulls from the registry
+    :param page_size int: number of objects requested per list call
+    :param metrics RunMetrics: metrics of the run, profiles the listing of every cluster
 
-    v1 = client.CoreV1Api()
-    api = client.AppsV1Api()
-    batch = client.BatchV1Api()
+    Collects the workload images of several clusters concurrently and merges them into one
+    deduplicated list. A cluster that can't be listed fails the run, since its images would
+    otherwise look unused.
+    :return images list:
+    """
 
-    logger.info("Getting Daemonsets from the K8s API")
-    daemonset_list = api.list_daemon_set_for_all_namespaces(watch=False)
-    for daemonset in daemonset_list.items:
-        k8s_images = parse_images(daemonset, k8s_images)
+    def list_cluster(context: str) -> list:
+        logger.info(f"Getting workload images from cluster {context}")
+        api_client = config.new_client_from_config(context=context)
+        try:
+            return get_images_from_workloads(page_size, api_client, metrics)
+        finally:
+            api_client.close()
 
-    logger.info("Getting Deployments from the K8s API")
-    deployment_list = api.list_deployment_for_all_namespaces(watch=False)
-    for deployment in deployment_list.items:
-        k8s_images = parse_images(deployment, k8s_images)
+    k8s_images = set()
+    with ThreadPoolExecutor(max_workers=len(contexts)) as executor:
+        futures = {
+            executor.submit(list_cluster, context): context for context in contexts
+        }
+        for future in as_completed(futures):
+            images = future.result()
+            logger.info(f"Found {len(images)} images in cluster {futures[future]}")
+            k8s_images.update(images)
 
-    logger.info("Getting Statefulset from the K8s API")
-    statefulset_list = api.list_stateful_set_for_all_namespaces(watch=False)
-    for statefulset in statefulset_list.items:
-        k8s_images = parse_images(statefulset, k8s_images)
+    return list(k8s_images)
 
-    logger.info("Getting Cronjobs from the K8s API")
-    cronjob_list = batch.list_cron_job_for_all_namespaces(watch=False)
-    for cronjob in cronjob_list.items:
-        k8s_images = parse_images(cronjob.spec.job_template, k8s_images)
 
-    logger.info("Getting Jobs from the K8s API")
-    job_list = batch.list_job_for_all_namespaces(watch=False)
-    for job in job_list.items:
-        k8s_images = parse_images(job, k8s_images)
+class ResourceExpired(Exception):
+    """
+    The resourceVersion a watch resumes from is older than the API server keeps, so the
+    kind has to be listed again.
+    """
 
-    logger.info("Getting Pods from the K8s API")
-    pod_list = v1.list_pod_for_all_namespaces(watch=False)
-    for pod in pod_list.items:
-        spec = pod.spec
-        if spec.init_containers:
-            for container in spec.init_containers:
-                k8s_images.append(container.image)
 
-        for container in spec.containers:
-            k8s_images.append(container.image)
+class ReferenceCache:
+    """
+    In-memory image references of every watched workload object. Each reference is
+    counted once per object using it, so it disappears with the last object and a sweep
+    can take a consistent ImageReferenceIndex at any time without listing anything.
+    """
 
-    logger.debug("converting the list of images to a set to only give unique values")
-    set_images = set(k8s_images)
-    logger.debug("convert set back to list for return")
-    unique_k8s_images = list(set_images)
+    def __init__(self):
+        self.counts = Counter()
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def set(self, key: tuple, images: set) -> None:
+        """
+        :param key tuple: source, namespace and name of the object
+        :param images set: references of the object, empty when it was deleted
+        """
+        with self.lock:
+            previous = self.objects.pop(key, set())
+            if images:
+                self.objects[key] = images
+            self.counts.update(images - previous)
+            self.counts.subtract(previous - images)
+            for image in previous - images:
+                if self.counts[image] <= 0:
+                    del self.counts[image]
+
+    def replace_source(self, source: tuple, objects: dict) -> None:
+        """
+        :param source tuple: cluster and kind whose objects were listed again
+        :param objects dict: (namespace, name) mapped to the references of the object
+        """
+        with self.lock:
+            stale = [key for key in self.objects if key[:-2] == source]
+        for key in stale:
+            if key[-2:] not in objects:
+                self.set(key, set())
+        for object_key, images in objects.items():
+            self.set((*source, *object_key), images)
+
+    def snapshot(self) -> "ImageReferenceIndex":
+        """
+        :return index ImageReferenceIndex: every reference in use right now
+        """
+        with self.lock:
+            references = list(self.counts)
+        return ImageReferenceIndex(references)
+
+
+def object_key(item: dict) -> tuple:
+    metadata = item.get("metadata") or {}
+    return metadata.get("namespace"), metadata.get("name")
+
+
+def watch_stream(
+    list_function, resource_version: str, timeout: int = WATCH_TIMEOUT
+):  # pragma: no cover
+    """
+    :param list_function: a list_*_for_all_namespaces function of the kubernetes client
+    :param resource_version str: version to resume from
+    :param timeout int: seconds the API server keeps the watch open
+    :return events generator: watch events with the raw JSON of each object in raw_object
+    """
+    return watch.Watch().stream(
+        list_function,
+        resource_version=resource_version,
+        timeout_seconds=timeout,
+        allow_watch_bookmarks=True,
+    )
 
-    return unique_k8s_images
 
+class WorkloadInformer:
+    """
+    Keeps the references of one workload kind up to date in a ReferenceCache. The kind is
+    listed once, then followed with a watch that resumes from the last seen
+    resourceVersion. The kind is only listed again when that version has expired.
+    synced is cleared whenever the watch fails and set again once the kind has been
+    listed or the watch has resumed, so sweeps never run against a stale cache.
+    """
 
-def get_ecr_repositories(
-    client: boto3.client, registry: str
+    def __init__(
+        self,
+        source: tuple,
+        list_function,
+        spec_path: tuple,
+        cache: ReferenceCache,
+        page_size: int = K8S_PAGE_SIZE,
+        stream=watch_stream,
+    ):
+        """
+        :param source tuple: cluster and kind, the prefix of the keys in the cache
+        :param list_function: a list_*_for_all_namespaces function of the kubernetes client
+        :param spec_path tuple: keys leading from an object to its pod spec
+        :param cache ReferenceCache: cache shared by every informer
+        :param page_size int: number of objects requested per list call
+        :param stream: function(list_function, resource_version) returning watch events
+        """
+        self.source = source
+        self.list_function = list_function
+        self.spec_path = spec_path
+        self.cache = cache
+        self.page_size = page_size
+        self.stream = stream
+        self.resource_version = None
+        self.synced = threading.Event()
+
+    def relist(self) -> None:
+        objects = {}
+        for page in iter_list_pages(self.list_function, self.page_size):
+            for item in page.get("items") or []:
+                objects[object_key(item)] = extract_item_images(item, self.spec_path)
+            self.resource_version = page.get("metadata", {}).get("resourceVersion")
+        self.cache.replace_source(self.source, objects)
+        logger.info(
+            f"Listed {len(objects)} {self.source[-1]}s at resourceVersion {self.resource_version}"
+        )
+        self.synced.set()
+
+    def apply(self, event: dict) -> None:
+        """
+        :param event dict: watch event with type and the raw JSON object
+        """
+        item = event.get("raw_object") or event.get("object") or {}
+        if event["type"] == "ERROR":
+            if item.get("code") == 410:
+                raise ResourceExpired(item.get("message"))
+            raise client.ApiException(
+                status=item.get("code"), reason=item.get("message")
+            )
+        if event["type"] in ("ADDED", "MODIFIED"):
+            self.cache.set(
+                (*self.source, *object_key(item)),
+                extract_item_images(item, self.spec_path),
+            )
+        elif event["type"] == "DELETED":
+            self.cache.set((*self.source, *object_key(item)), set())
+        # Bookmarks only move the resourceVersion forward
+        self.resource_version = (
+            item.get("metadata", {}).get("resourceVersion") or self.resource_version
+        )
+
+    def watch_once(self) -> None:
+        """
+        Lists the kind if there is no version to resume from, then applies the events of
+        one watch until the server closes it.
+        """
+        if self.resource_version is None:
+            self.relist()
+        try:
+            for event in self.stream(self.list_function, self.resource_version):
+                self.apply(event)
+                # The watch resumed, so no event has been missed
+                self.synced.set()
+        except ResourceExpired:
+            self.expired()
+        except client.ApiException as e:
+            if e.status != 410:
+                raise
+            self.expired()
+        else:
+            self.synced.set()
+
+    def expired(self) -> None:
+        # Events since the expired version are lost until the kind is listed again
+        logger.info(f"resourceVersion of {self.source} expired, listing again")
+        self.synced.clear()
+        self.resource_version = None
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                self.watch_once()
+            except Exception as e:
+                self.synced.clear()
+                logger.error(f"Watching {self.source} failed, retrying: {e}")
+                stop.wait(5)
+
+
+def informers_synced(informers: list, metrics: RunMetrics) -> bool:
+    """
+    :param informers list: WorkloadInformers feeding the reference cache
+    :param metrics RunMetrics: metrics of the run, records the unsynced informers
+    :return bool: True if every informer is in sync and the cache can be swept against
+    """
+    unsynced = [
+        informer.source for informer in informers if not informer.synced.is_set()
+    ]
+    metrics.set("unsynced_informers", len(unsynced))
+    if unsynced:
+        # Images of workloads created while a watch was down would look unused
+        logger.error(
+            f"Skipping the sweep, {len(unsynced)} workload watches are out of sync: {unsynced}"
+        )
+        return False
+    return True
+
+
+def start_informers(
+    cache: ReferenceCache, contexts: list, page_size: int, stop: threading.Event
 ) -> list:  # pragma: no cover
+    """
+    :param cache ReferenceCache: cache the informers keep up to date
+    :param contexts list: kubeconfig contexts to watch, the loaded config if empty
+    :param page_size int: number of objects requested per list call
+    :param stop threading.Event: ends the watches when set
+    :return informers list: one running informer per cluster and workload kind
+    """
+    informers = []
+    for context in contexts or [None]:
+        api_client = config.new_client_from_config(context=context) if context else None
+        for kind, list_function in get_workload_listers(api_client).items():
+            informer = WorkloadInformer(
+                (context, kind),
+                list_function,
+                WORKLOAD_SPEC_PATHS[kind],
+                cache,
+                page_size,
+            )
+            threading.Thread(
+                target=informer.run,
+                args=(stop,),
+                name=f"watch-{context}-{kind}",
+                daemon=True,
+            ).start()
+            informers.append(informer)
+    return informers
+
+
+def is_unapproved(value: str | None) -> bool:
+    """
+    :param value str: value of the Approved tag, None when the repository doesn't have it
+    :return bool: True when the repository is tagged Approved=false (or an empty value)
+    """
+    return value is not None and value.strip().lower() in ("", "false")
+
+
+def get_approved_tags_from_tagging_api(tagging_client: boto3.client) -> dict:
+    """
+    :param tagging_client boto3.client: resourcegroupstaggingapi client
+
+    Reads the Approved tag of every ECR repository with a handful of paginated calls.
+    Only repositories that carry the tag are returned.
+    :return tags dict: repository ARN mapped to the value of its Approved tag
+    """
+    tags = {}
+    paginator = tagging_client.get_paginator("get_resources")
+    for response in paginator.paginate(
+        ResourceTypeFilters=["ecr:repository"], TagFilters=[{"Key": "Approved"}]
+    ):
+        for mapping in response["ResourceTagMappingList"]:
+            for tag in mapping["Tags"]:
+                if tag["Key"] == "Approved":
+                    tags[mapping["ResourceARN"]] = tag["Value"]
+    return tags
+
+
+def get_approved_tags_per_repository(
+    client: boto3.client, arns: list, concurrency: int = 1
+) -> dict:
+    """
+    :param client boto3.client:
+    :param arns list: repository ARNs
+    :param concurrency int: number of list_tags_for_resource calls in flight
+    :return tags dict: repository ARN mapped to the value of its Approved tag, or None
+    """
+
+    def approved_tag(arn: str) -> str | None:
+        for tag in client.list_tags_for_resource(resourceArn=arn)["tags"]:
+            if tag["Key"] == "Approved":
+                return tag["Value"]
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return dict(zip(arns, executor.map(approved_tag, arns)))
+
+
+def load_tag_cache(path: str, ttl: int, now: float) -> dict:
+    """
+    :return tags dict: cached Approved tags by ARN, empty when the cache is missing or older than ttl seconds
+    """
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if now - cache.get("fetched_at", 0) > ttl:
+        logger.info("Repository tag cache expired")
+        return {}
+    return cache.get("tags", {})
+
+
+def save_tag_cache(path: str, tags: dict, now: float) -> None:
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as cache_file:
+        json.dump({"fetched_at": now, "tags": tags}, cache_file)
+    os.replace(temporary_path, path)
+
+
+def get_repository_approved_tags(
+    client: boto3.client,
+    arns: list,
+    tagging_client: boto3.client = None,
+    cache_path: str | None = None,
+    cache_ttl: int = TAG_CACHE_TTL,
+    concurrency: int = 1,
+) -> dict:
+    """
+    :param client boto3.client:
+    :param arns list: repository ARNs
+    :param tagging_client boto3.client: optional resourcegroupstaggingapi client
+    :param cache_path str: optional file caching the tags for cache_ttl seconds
+    :param concurrency int: number of list_tags_for_resource calls in flight
+
+    Finds the Approved tag of every repository from the cheapest source available: a
+    fresh cache, then the Resource Groups Tagging API, and only then one
+    list_tags_for_resource call per repository the other sources don't cover.
+    :return tags dict: repository ARN mapped to the value of its Approved tag, or None
+    """
+    now = time.time()
+    tags = load_tag_cache(cache_path, cache_ttl, now) if cache_path else {}
+    missing = [arn for arn in arns if arn not in tags]
+
+    if missing and tagging_client:
+        try:
+            tagged = get_approved_tags_from_tagging_api(tagging_client)
+        except ClientError as error:
+            logger.warning(
+                f"Unable to read tags from the Resource Groups Tagging API, falling back to per repository calls: {error}"
+            )
+        else:
+            # The Tagging API only returns tagged resources, so every other repository has no Approved tag
+            tags.update({arn: tagged.get(arn) for arn in missing})
+            missing = []
+
+    if missing:
+        logger.info(f"Reading tags of {len(missing)} repositories one by one")
+        tags.update(get_approved_tags_per_repository(client, missing, concurrency))
+
+    if cache_path:
+        save_tag_cache(cache_path, tags, now)
+    return {arn: tags[arn] for arn in arns}
+
+
+def get_ecr_repositories(
+    client: boto3.client,
+    registry: str,
+    tagging_client: boto3.client = None,
+    tag_cache_path: str | None = None,
+    tag_cache_ttl: int = TAG_CACHE_TTL,
+    concurrency: int = 1,
+    delete_unapproved: bool = False,
+) -> list:
     """
     :param client boto3.client:
     :param registry str:
+    :param tagging_client boto3.client: optional resourcegroupstaggingapi client
+    :param tag_cache_path str: optional file caching repository tags
+    :param tag_cache_ttl int: seconds the tag cache stays valid
+    :param concurrency int: number of per repository tag calls in flight
+    :param delete_unapproved bool: mark repositories tagged Approved=false for forced deletion,
+        the Approved tags aren't read at all otherwise
     Gets a list of image repositories in a registry
     :return repositories list:
     """
-    logging.debug("Attempting to retrieve a list of repositories in ECR")
-    repositories = []
+    logger.debug("Attempting to retrieve a list of repositories in ECR")
+    described = []
     paginator = client.get_paginator("describe_repositories")
     for response in paginator.paginate(registryId=registry):
         logger.debug(f"{response=}")
-        for repository in response["repositories"]:
-            logger.debug(f"{repository=}")
+        described.extend(response["repositories"])
+
+    # The Approved tag only matters to forced deletion, so don't pay for it otherwise
+    tags = {}
+    if delete_unapproved:
+        tags = get_repository_approved_tags(
+            client,
+            [repository["repositoryArn"] for repository in described],
+            tagging_client,
+            tag_cache_path,
+            tag_cache_ttl,
+            concurrency,
+        )
 
-            tags = client.list_tags_for_resource(
-                resourceArn=repository["repositoryArn"]
+    repositories = []
+    for repository in described:
+        logger.debug(f"{repository=}")
+        repo = {
+            "registry_id": repository["registryId"],
+            "repository_name": repository["repositoryName"],
+            "repository_uri": repository["repositoryUri"],
+        }
+        if is_unapproved(tags.get(repository["repositoryArn"])):
+            logger.info(
+                f"Images in repo {repository['repositoryName']} should be deleted"
             )
-
-            repo = {
-                "repository_name": repository["repositoryName"],
-                "repository_uri": repository["repositoryUri"],
-            }
-
-            for tag in tags["tags"]:
-                if tag["Key"] == "Approved" and not bool(tag["Value"]):
-                    logger.info("Images in repo should be deleted")
-                    repo["delete"] = True
-
-            repositories.append(repo)
+            repo["delete"] = True
+        repositories.append(repo)
 
     logger.debug(repositories)
     return repositories
 
 
-def get_ecr_images(
-    client: boto3.client, registry_id: str, repositories: list, minimum_image_age: int
-) -> tuple[list, dict]:  # pragma: no cover
+def scan_repository(
+    client: boto3.client,
+    registry_id: str,
+    repository: dict,
+    policy: RetentionPolicy,
+    cache: SubjectCache | None = None,
+    metrics: RunMetrics | None = None,
+) -> tuple[list, dict, Counter, str]:
     """
     :param client boto3.client:
-    :param repositories list:
-    :return images list: returns a list of images located in a registry
+    :param registry_id str:
+    :param repository dict:
+    :param policy RetentionPolicy: retention windows of this run
+    :param cache SubjectCache: optional cache of artifact subject digests
+    :param metrics RunMetrics: metrics of the run, profiles the scan on the worker running it
+    Pages through describe_images for a single repository. Each page feeds the retention
+    rules, the artifact index, the image set fingerprint and the forced deletion of
+    repositories tagged for deletion (through ImageRecord.force_delete) so no second walk
+    over the repository is needed.
+    :return images list, artifact_index dict, stats Counter, fingerprint str: the images and
+    artifacts found in the repository, the subject resolution counts and phase durations of
+    the scan, and the image set fingerprint for incremental mode
     """
-    logging.debug("Attempting to retrieve a list of images in ECR")
+    started = time.monotonic()
     images = []
+    artifacts = []
+    image_ids = []
+    live_digests = set()
     artifact_index = defaultdict(list)
-    paginator = client.get_paginator("describe_images")
-    for repository in repositories:
+    metrics = metrics or RunMetrics()
+    with metrics.profile("scan", allocations=False):
+        paginator = client.get_paginator("describe_images")
         for response in paginator.paginate(
             registryId=registry_id, repositoryName=repository["repository_name"]
         ):
             imageDetails = response["imageDetails"]
             logger.debug(imageDetails)
-            if len(imageDetails) == 1:
+            live_digests.update(image["imageDigest"] for image in imageDetails)
+            image_ids.extend(
+                {
+                    "imageDigest": image["imageDigest"],
+                    "imageTags": image.get("imageTags"),
+                }
+                for image in imageDetails
+            )
+            if len(imageDetails) == 1 and not repository.get("delete"):
+                only_image = (
+                    f"{repository['repository_uri']}@{imageDetails[0]['imageDigest']}"
+                )
                 logger.info(
-                    f"Image {repository['repository_uri']}@{imageDetails[0]['imageDigest']} is the only image in the repository skipping"
+                    f"Image {only_image} is the only image in the repository skipping"
                 )
-                if "lastRecordedPullTime" in imageDetails:
-                    last_pull_time = imageDetails["lastRecordedPullTime"]
-                    localized_now_ts = UTC.localize(
-                        datetime.now() - timedelta(minimum_image_age)
-                    )
-                    if last_pull_time > localized_now_ts:
-                        logger.debug(
-                            f"The last pulltime was more than {minimum_image_age} days ago. Skipping image."
-                        )
-                        logger.info(
-                            f"Image {repository['repository_uri']}@{imageDetails[0]['imageDigest']} is the only image in the repository skipping and hasn't been pulled in 7 days, consider deleting"
-                        )
-                else:
+                last_pull_time = epoch_seconds(
+                    imageDetails[0].get("lastRecordedPullTime")
+                )
+                if last_pull_time is None or last_pull_time <= policy.pull_cutoff:
                     logger.info(
-                        f"Image {repository['repository_uri']}@{imageDetails[0]['imageDigest']} is the only image in the repository skipping and hasn't been pulled in 7 days, consider deleting"
+                        f"Image {only_image} is the only image in the repository skipping and hasn't been pulled in {policy.pull_window_days} days, consider deleting"
                     )
                 break
             for image in imageDetails:
-                built_image = build_image_uri(image, repository)
-                if built_image:
-                    images.append(built_image)
+                # Only keep a compact record, the full dict with its scan findings is dropped with the page
+                if is_container_manifest(image):
+                    images.append(ImageRecord.from_image(image, repository))
                 else:
-                    subject_digest = get_artifact_subject_digest(
-                        client, registry_id, repository, image
-                    )
-                    if subject_digest:
-                        artifact_entry = image.copy()
-                        artifact_entry["repository_uri"] = repository["repository_uri"]
-                        artifact_entry["image_uri"] = (
-                            f"{repository['repository_uri']}@{image['imageDigest']}"
-                        )
-                        artifact_entry["subjectDigest"] = subject_digest
-                        artifact_index[subject_digest].append(artifact_entry)
+                    artifacts.append(image)
+
+        if cache:
+            cache.prune(repository["repository_name"], live_digests)
+    scanned = time.monotonic()
+    with metrics.profile("artifact_resolution", allocations=False):
+        subject_digests, stats = resolve_artifact_subjects(
+            client, registry_id, repository, artifacts, cache
+        )
+    stats["scan_seconds"] += scanned - started
+    stats["artifact_resolution_seconds"] += time.monotonic() - scanned
+    for image in artifacts:
+        subject_digest = subject_digests.get(image["imageDigest"])
+        if subject_digest:
+            artifact_entry = ImageRecord.from_image(image, repository)
+            # Artifacts are addressed by digest, their tags only name the subject
+            artifact_entry.tags = ()
+            artifact_entry.subject_digest = subject_digest
+            artifact_index[subject_digest].append(artifact_entry)
+    return images, artifact_index, stats, image_set_fingerprint(image_ids)
+
+
+def iter_in_order(function, items: list, concurrency: int = 1):
+    """
+    :param function: called with every item
+    :param items list:
+    :param concurrency int: number of worker threads
+
+    Runs function over items on a thread pool and yields the results in the order of items.
+    At most twice as many calls as there are workers are in flight, so finished results
+    never pile up while an earlier, slower item is still running.
+    :return results generator:
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_ecr_images(
+    client: boto3.client,
+    registry_id: str,
+    repositories: list,
+    policy: RetentionPolicy,
+    concurrency: int = 1,
+    cache: SubjectCache | None = None,
+    metrics: RunMetrics | None = None,
+):  # pragma: no cover
+    """
+    :param client boto3.client:
+    :param repositories list:
+    :param policy RetentionPolicy: retention windows of this run
+    :param concurrency int: number of repositories to scan at the same time
+    :param cache SubjectCache: optional cache of artifact subject digests
+    :param metrics RunMetrics: metrics of the run, profiles the scans
+
+    Scans repositories and yields each one as soon as its pages and referrers are complete,
+    in the order of repositories, so only a handful of repositories are held in memory.
+    :return scans generator: (images, artifact_index, stats, fingerprint) for every repository
+    """
+    logger.debug("Attempting to retrieve a list of images in ECR")
+    if concurrency > 1:
+        logger.info(
+            f"Scanning {len(repositories)} repositories with {concurrency} workers"
+        )
+    stats = Counter()
+    for scan in iter_in_order(
+        lambda repository: scan_repository(
+            client, registry_id, repository, policy, cache, metrics
+        ),
+        repositories,
+        concurrency,
+    ):
+        stats.update(scan[2])
+        yield scan
+
+    logger.info(
+        f"Resolved {stats['subject_tag_hits']} artifact subjects from tags, {stats['subject_cache_hits']} from the cache, "
+        f"fetched {stats['subject_manifest_fetches']} manifests"
+    )
+    if cache:
+        evicted = cache.evict()
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the subject cache")
+
+
+def image_set_fingerprint(image_ids: list) -> str:
+    """
+    :param image_ids list: imageIds from list_images or imageDetails from describe_images
+
+    Hashes the (digest, tag) pairs of a repository so a changed image set, including moved
+    tags, can be detected without keeping every digest in the state file.
+    :return fingerprint str:
+    """
+    pairs = set()
+    for image_id in image_ids:
+        tags = image_id.get("imageTags") or [image_id.get("imageTag", "")]
+        for tag in tags:
+            pairs.add(f"{image_id['imageDigest']}:{tag}")
+    return hashlib.sha256("\n".join(sorted(pairs)).encode()).hexdigest()
+
+
+def get_repository_fingerprints(
+    client: boto3.client, registry_id: str, repositories: list, concurrency: int = 1
+) -> dict:  # pragma: no cover
+    """
+    Lists the imageIds of repositories that are not deep-scanned anyway, which is much
+    lighter than describe_images, and fingerprints them. Deep-scanned repositories get their
+    fingerprint from scan_repository.
+    :return fingerprints dict: repository name mapped to its image set fingerprint
+    """
+
+    def fingerprint(repository: dict) -> str:
+        image_ids = []
+        paginator = client.get_paginator("list_images")
+        for response in paginator.paginate(
+            registryId=registry_id, repositoryName=repository["repository_name"]
+        ):
+            image_ids.extend(response["imageIds"])
+        return image_set_fingerprint(image_ids)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        fingerprints = executor.map(fingerprint, repositories)
+        return {
+            repository["repository_name"]: repository_fingerprint
+            for repository, repository_fingerprint in zip(repositories, fingerprints)
+        }
+
+
+def next_retention_boundaries(images: list, policy: RetentionPolicy) -> dict:
+    """
+    :param images list: container images of one repository from iter_ecr_images
+    :param policy RetentionPolicy: retention windows and reference time of this run
+
+    Works out, per repository, the earliest moment an image that is still protected at the
+    reference time becomes old enough to be considered for deletion.
+    :return boundaries dict: repository name mapped to epoch seconds
+    """
+    boundaries = {}
+    for image in images:
+        protected_until = [
+            timestamp + window * 86400
+            for timestamp, window in (
+                (image.pushed_at, policy.push_window_days),
+                (image.pulled_at, policy.pull_window_days),
+            )
+            if timestamp is not None
+        ]
+        if not protected_until:
+            continue
+        boundary = max(protected_until)
+        if boundary <= policy.reference_time:
+            continue
+        repository_name = image.repository_name
+        boundaries[repository_name] = min(
+            boundary, boundaries.get(repository_name, boundary)
+        )
+    return boundaries
+
+
+def is_full_scan_due(state: dict, now: float, full_scan_interval: int) -> bool:
+    """
+    :param state dict: state saved by the previous incremental run
+    :param now float: epoch seconds of this run
+    :param full_scan_interval int: days between forced full scans
+    :return bool: True when every repository should be scanned regardless of the state
+    """
+    last_full_scan = state.get("last_full_scan")
+    if last_full_scan is None:
+        return True
+    return now - last_full_scan >= full_scan_interval * 86400
+
+
+def is_scan_due(repository: dict, known: dict, now: float) -> bool:
+    """
+    :param repository dict: repository from get_ecr_repositories
+    :param known dict: repository entries of the saved state
+    :param now float: epoch seconds of this run
+    :return due bool: whether the repository is deep-scanned whatever its fingerprint, because
+    it is new, crossed the age boundary or is tagged for deletion
+    """
+    entry = known.get(repository["repository_name"])
+    return bool(
+        repository.get("delete")
+        or entry is None
+        or (entry["next_boundary"] is not None and entry["next_boundary"] <= now)
+    )
 
-    logger.debug(f"{images=}")
-    return images, dict(artifact_index)
 
+def select_changed_repositories(
+    repositories: list, fingerprints: dict, state: dict, now: float
+) -> list:
+    """
+    :param repositories list: repositories from get_ecr_repositories
+    :param fingerprints dict: current image set fingerprints by repository name
+    :param state dict: state saved by the previous incremental run
+    :param now float: epoch seconds of this run
 
-def is_image_pushed_recently(image: dict) -> bool:
+    Picks the repositories that need a deep scan: new or changed image sets, images that
+    have crossed the age boundary since the last run and repositories tagged for deletion.
+    :return repositories list:
+    """
+    known = state.get("repositories", {})
+    selected = []
+    for repository in repositories:
+        name = repository["repository_name"]
+        if is_scan_due(repository, known, now) or known[name][
+            "fingerprint"
+        ] != fingerprints.get(name):
+            selected.append(repository)
+    logger.info(
+        f"Incremental scan: {len(selected)} of {len(repositories)} repositories changed or crossed the age boundary"
+    )
+    return selected
+
+
+def update_scan_state(
+    state: dict,
+    repositories: list,
+    scanned: list,
+    fingerprints: dict,
+    boundaries: dict,
+    pending_repositories: set,
+    now: float,
+    full_scan: bool,
+) -> dict:
     """
-    :param image dict: image details
-    Checks to see if the image has been pushed in the last 7 days
-    :return bool: if the image has been pushed in the last 7 days True will be returned
+    Records the fingerprint and next age boundary of every scanned repository. Repositories
+    that had deletable images are left out so the next run evaluates them again, which
+    covers dry runs and failed deletions.
+    :return state dict: the new state
     """
-    logging.debug("Checking if the image has been pushed recently")
+    known = state.get("repositories", {})
+    current = {repository["repository_name"] for repository in repositories}
+    entries = {name: entry for name, entry in known.items() if name in current}
+    for repository in scanned:
+        name = repository["repository_name"]
+        entries[name] = {
+            "fingerprint": fingerprints.get(name),
+            "next_boundary": boundaries.get(name),
+        }
+    for name in pending_repositories:
+        entries.pop(name, None)
+    return {
+        "last_run": now,
+        "last_full_scan": now if full_scan else state.get("last_full_scan"),
+        "repositories": entries,
+    }
+
+
+def load_scan_state(path: str) -> dict:
+    """
+    :return state dict: the saved state, or an empty state when there is none yet
+    """
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        logger.warning(f"Ignoring unreadable incremental state {path}")
+        return {}
+
+
+def save_scan_state(path: str, state: dict) -> None:
+    # Write to a temporary file first so an interrupted run never leaves a truncated state
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, path)
+
+
+def is_image_pushed_recently(
+    image: ImageRecord, policy: RetentionPolicy | None = None
+) -> bool:
+    """
+    :param image ImageRecord: image details
+    :param policy RetentionPolicy: retention windows of this run, defaults to 7 days from now
+    Checks to see if the image has been pushed within the push window
+    :return bool: if the image has been pushed within the push window True will be returned
+    """
+    policy = policy or RetentionPolicy.from_now()
+    logger.debug("Checking if the image has been pushed recently")
     logger.debug(f"{image=}")
-    if "imagePushedAt" in image:
-        last_pull_time = image["imagePushedAt"]
-        localized_now_ts = UTC.localize(datetime.now() - timedelta(7))
-        logger.debug(last_pull_time)
-        logger.debug(localized_now_ts)
-        if last_pull_time > localized_now_ts:
-            logger.debug("The last pulltime was more than 7 days ago")
+    if image.pushed_at is not None:
+        logger.debug(image.pushed_at)
+        logger.debug(policy.push_cutoff)
+        if image.pushed_at > policy.push_cutoff:
+            logger.debug(
+                f"The image was pushed less than {policy.push_window_days} days ago"
+            )
             return True
         else:
             return False
     else:
         logger.info(
-            f"There is no imagePushedAt because the {image['image_uri']} has something terribly wrong with it"
+            f"There is no imagePushedAt because the {image.image_uri} has something terribly wrong with it"
         )
         return False
 
 
-def is_image_pulled_recently(image: dict) -> bool:
+def is_image_pulled_recently(
+    image: ImageRecord, policy: RetentionPolicy | None = None
+) -> bool:
     """
-    :param image dict: image details
-    Checks to see if the image has been pulled in the last 7 days
-    :return bool: if the image has been pulled in the last 7 days True will be returned
+    :param image ImageRecord: image details
+    :param policy RetentionPolicy: retention windows of this run, defaults to 7 days from now
+    Checks to see if the image has been pulled within the pull window
+    :return bool: if the image has been pulled within the pull window True will be returned
     """
-    logging.debug("Checking if the image has been pulled recently")
+    policy = policy or RetentionPolicy.from_now()
+    logger.debug("Checking if the image has been pulled recently")
     logger.debug(f"{image=}")
-    if "lastRecordedPullTime" in image:
-        last_pull_time = image["lastRecordedPullTime"]
-        localized_now_ts = UTC.localize(datetime.now() - timedelta(7))
-        logger.debug(last_pull_time)
-        logger.debug(localized_now_ts)
-        if last_pull_time > localized_now_ts:
-            logger.debug("The last pulltime was more than 7 days ago")
+    if image.pulled_at is not None:
+        logger.debug(image.pulled_at)
+        logger.debug(policy.pull_cutoff)
+        if image.pulled_at > policy.pull_cutoff:
+            logger.debug(
+                f"The image was pulled less than {policy.pull_window_days} days ago"
+            )
             return True
         else:
             return False
     else:
         logger.info(
-            f"There is no lastRecordPullTime because the {image['image_uri']} has never been pulled or ECR has no record of it being pulled"
+            f"There is no lastRecordPullTime because the {image.image_uri} has never been pulled or ECR has no record of it being pulled"
         )
         return False
 
 
-def is_image_tagged_keep(image: dict) -> bool:
+def is_image_tagged_keep(
+    image: ImageRecord, policy: RetentionPolicy | None = None
+) -> bool:
     """
-    :param image dict: imgae response from ecr client
+    :param image ImageRecord: image details
+    :param policy RetentionPolicy: protected tag patterns, defaults to the tag keep
 
-    Checks to see if the tag is the only one in the ecr repository.
-    :return bool: if the tag of the image is keep then don't delete
+    Checks to see if any tag of the image is protected by the policy.
+    :return bool: if a tag of the image is protected then don't delete
     """
-    if "imageTags" in image:
-        logger.debug(f"{image['imageTags']=}")
-        if "keep" in image["imageTags"]:
-            logger.info(f"{image['image_uri']} was tagged keep")
+    policy = policy or RetentionPolicy.from_now()
+    if image.tags:
+        logger.debug(f"{image.tags=}")
+        if policy.protects(image.tags):
+            logger.info(f"{image.image_uri} was tagged keep")
             return True
         else:
-            logger.info(f"{image['image_uri']} was not tagged keep")
+            logger.info(f"{image.image_uri} was not tagged keep")
             return False
     else:
-        logger.debug(f"{image['image_uri']} has no tags configured")
+        logger.debug(f"{image.image_uri} has no tags configured")
         return False
 
 
-def is_image_referenced(image: dict, images: list) -> bool:
+def parse_image_reference(reference: str) -> tuple[str, str | None, str | None]:
+    """
+    :param reference str: image reference as written in a pod spec, e.g. nginx, repo:tag,
+    repo@sha256:... or registry/repo:tag@sha256:...
+
+    Normalizes a reference the way the container runtime resolves it: a missing registry
+    means Docker Hub, single component Docker Hub names live under library/ and a missing
+    tag and digest means latest.
+    :return repository str, tag str, digest str: repository includes the registry
+    """
+    name, _, digest = reference.partition("@")
+    tag = None
+    if name.rfind(":") > name.rfind("/"):
+        name, _, tag = name.rpartition(":")
+
+    registry, _, path = name.partition("/")
+    if not path or not ("." in registry or ":" in registry or registry == "localhost"):
+        registry, path = DOCKER_HUB_REGISTRY, name
+    registry = registry.lower()
+    if registry in DOCKER_HUB_ALIASES:
+        registry = DOCKER_HUB_REGISTRY
+        if "/" not in path:
+            path = f"library/{path}"
+
+    if not tag and not digest:
+        tag = "latest"
+    return f"{registry}/{path}", tag, digest or None
+
+
+class ImageReferenceIndex:
+    """
+    Normalized set of the images workloads reference, built once per run so each ECR image
+    is checked in constant time by any of its tags or by its digest.
     """
-    :param image dict: full name of the image
-    :param image list: list of images that k8s knows about/uses
+
+    def __init__(self, references=()):
+        self.tags = set()
+        self.digests = set()
+        self.update(references)
+
+    def add(self, reference: str) -> None:
+        repository, tag, digest = parse_image_reference(reference)
+        # repo:tag@digest runs the digest, but keeping the tag as well errs on the side of keeping images
+        if tag:
+            self.tags.add((repository, tag))
+        if digest:
+            self.digests.add((repository, digest))
+
+    def update(self, references) -> None:
+        for reference in references:
+            self.add(reference)
+
+    def __len__(self) -> int:
+        return len(self.tags) + len(self.digests)
+
+    def is_referenced(self, repository: str, tags, digests) -> bool:
+        """
+        :param repository str: normalized repository including the registry
+        :param tags iterable: tags of the image
+        :param digests iterable: digests of the image
+        :return bool: True if any tag or digest of the image is in use
+        """
+        return any((repository, tag) in self.tags for tag in tags) or any(
+            (repository, digest) in self.digests for digest in digests
+        )
+
+    def references_image(self, image: ImageRecord) -> bool:
+        """
+        :param image ImageRecord: image details
+        :return bool: True if a workload uses the image by any of its tags or its digest
+        """
+        repository, uri_tag, uri_digest = parse_image_reference(image.image_uri)
+        tags = set(image.tags)
+        if uri_tag:
+            tags.add(uri_tag)
+        digests = {digest for digest in (image.digest, uri_digest) if digest}
+        return self.is_referenced(repository, tags, digests)
+
+
+def is_image_referenced(image: ImageRecord, images) -> bool:
+    """
+    :param image ImageRecord: image details
+    :param images ImageReferenceIndex: images that k8s knows about/uses, a plain list is indexed on the fly
 
     Checks to see if the image is referenced in any pods or pod creation controllers (i.e. deployments, cronjobs, statefulsets, jobs, daemonsets)
+    by any of its tags or its digest.
     :return bool: if the image is referenced in a workload object True will be returned.
     """
-    if image["image_uri"] in images:
-        logger.info(f"{image['image_uri']} was found in k8s workload")
+    if not isinstance(images, ImageReferenceIndex):
+        images = ImageReferenceIndex(images)
+
+    if images.references_image(image):
+        logger.info(f"{image.image_uri} was found in k8s workload")
         return True
     else:
-        logger.info(f"{image['image_uri']} was not found in k8s workload")
+        logger.info(f"{image.image_uri} was not found in k8s workload")
         return False
 
 
-def is_repository_approved(
-    client: boto3.client, registry_id: str, repositories: dict, images: list
-) -> list:
-    paginator = client.get_paginator("describe_images")
-    for repository in repositories:
-        for response in paginator.paginate(
-            registryId=registry_id, repositoryName=repository["repository_name"]
-        ):
-            imageDetails = response["imageDetails"]
-            logger.debug(imageDetails)
-            if "delete" in repository and repository["delete"]:
-                logger.info("Repo is tagged for deletion")
-                images = append_image(images, imageDetails, repository)
-    return images
-
-
-def is_image_deletable(image: dict, k8s_images: list) -> bool:
+def is_image_deletable(
+    image: ImageRecord, k8s_images, policy: RetentionPolicy | None = None
+) -> bool:
     """
-    :param image dict: image details from aws
+    :param image ImageRecord: image details from aws
+    :param k8s_images ImageReferenceIndex: images referenced by workloads
+    :param policy RetentionPolicy: retention windows of this run, defaults to 7 days from now
 
     Evaluates an image against a set of rules to determine if it should be deleted.
 
     :return bool: if the image should be deleted True will be returned
     """
-    # TODO: Make it handle multiple tags
+    policy = policy or RetentionPolicy.from_now()
+    if image.force_delete:
+        logger.info(f"{image.image_uri} is in a repository tagged for deletion")
+        # Even unapproved images stay while a workload still runs them or a tag protects them
+        return not (
+            is_image_referenced(image, k8s_images)
+            or is_image_tagged_keep(image, policy)
+        )
 
     if (
-        is_image_pushed_recently(image)
+        is_image_pushed_recently(image, policy)
         or is_image_referenced(image, k8s_images)
-        or is_image_pulled_recently(image)
-        or is_image_tagged_keep(image)
+        or is_image_pulled_recently(image, policy)
+        or is_image_tagged_keep(image, policy)
     ):
-        logger.debug(f"{image['image_uri']} is not deletable")
+        logger.debug(f"{image.image_uri} is not deletable")
         return False
     else:
-        logger.debug(f"{image['image_uri']} is deletable")
+        logger.debug(f"{image.image_uri} is deletable")
         return True
 
 
-def delete_image(client: boto3.client, image: dict):  # pragma: no cover
+def deletable_mask(images: list, k8s_images, policy: RetentionPolicy) -> list:
     """
-    :param client boto3.client: configuration for boto3
-    :param image dict: image response from ecr client
+    :param images list: ImageRecords to evaluate
+    :param k8s_images ImageReferenceIndex: images referenced by workloads
+    :param policy RetentionPolicy: retention windows of this run
+
+    Batch equivalent of is_image_deletable. The mask is computed in a single pass against
+    the policy's precomputed cutoffs, without a log line per image, and the cheap time checks
+    run before the tag patterns and the reference lookup.
+    :return mask list: True for every image that should be deleted
+    """
+    if not isinstance(k8s_images, ImageReferenceIndex):
+        k8s_images = ImageReferenceIndex(k8s_images)
+
+    push_cutoff = policy.push_cutoff
+    pull_cutoff = policy.pull_cutoff
+    mask = []
+    for image in images:
+        if image.force_delete:
+            retained = False
+        else:
+            pushed = NEVER if image.pushed_at is None else image.pushed_at
+            pulled = NEVER if image.pulled_at is None else image.pulled_at
+            retained = pushed > push_cutoff or pulled > pull_cutoff
+        mask.append(
+            not (
+                retained
+                or policy.protects(image.tags)
+                or k8s_images.references_image(image)
+            )
+        )
+    return mask
 
-    Deletes an image from ECR
+
+def semver_key(tag: str) -> tuple | None:
+    """
+    :param tag str: image tag, e.g. v1.2.3 or 1.2.3-rc.1
+    :return key tuple: sortable semantic version, None if the tag isn't one
     """
+    match = SEMVER_PATTERN.fullmatch(tag)
+    if not match:
+        return None
+    prerelease = match.group("prerelease")
+    # A release sorts after its prereleases, numeric identifiers sort before alphanumeric ones
+    identifiers = ()
+    if prerelease:
+        identifiers = tuple(
+            (0, int(part), "") if part.isdigit() else (1, 0, part)
+            for part in prerelease.split(".")
+        )
+    return (
+        int(match.group("major")),
+        int(match.group("minor")),
+        int(match.group("patch")),
+        not prerelease,
+        identifiers,
+    )
+
 
+def keep_last_key(image: ImageRecord, policy: RetentionPolicy, prefix: str = ""):
     """
-    ECR.Client.exceptions.ServerException
+    :param image ImageRecord:
+    :param policy RetentionPolicy: keep_last_by selects push time or semantic version
+    :param prefix str: only tags starting with prefix count, the prefix is stripped before parsing
+    :return key: ordering key of the image, None if it doesn't take part
+    """
+    tags = [tag[len(prefix) :] for tag in image.tags if tag.startswith(prefix)]
+    if prefix and not tags:
+        return None
+    if policy.keep_last_by == "semver":
+        return max(filter(None, map(semver_key, tags)), default=None)
+    return image.pushed_at
 
-    ECR.Client.exceptions.InvalidParameterException
 
-    ECR.Client.exceptions.RepositoryNotFoundException
+def keep_last_indexes(images: list, policy: RetentionPolicy) -> set:
     """
-    logger.info(f"Deleting {image['image_uri']}")
-    if os.getenv("DRY_RUN"):
-        return True
-    else:
-        client.batch_delete_image(
-            registryId=image["registryId"],
-            repositoryName=image["repositoryName"],
-            imageIds=[
-                {"imageDigest": image["imageDigest"]},
-            ],
+    :param images list: ImageRecords of one repository
+    :param policy RetentionPolicy: keep_last, keep_last_by and keep_last_prefixes
+
+    Selects the newest keep_last images of the repository, or of every tag prefix when
+    keep_last_prefixes is set, with a bounded heap instead of sorting the repository.
+    :return indexes set: positions of the images kept by the rule
+    """
+    kept = set()
+    for prefix in policy.keep_last_prefixes or ("",):
+        candidates = (
+            (key, index)
+            for index, key in enumerate(
+                keep_last_key(image, policy, prefix) for image in images
+            )
+            if key is not None
         )
+        kept.update(index for _, index in heapq.nlargest(policy.keep_last, candidates))
+    return kept
 
 
-def main():  # pragma: no cover
+def evaluate_repository(
+    images: list,
+    artifact_index: dict,
+    k8s_images,
+    policy: RetentionPolicy | None = None,
+) -> list:
+    """
+    :param images list: ImageRecords of the container images of one repository
+    :param artifact_index dict: artifacts of the repository by subject digest
+    :param k8s_images ImageReferenceIndex: images referenced by workloads
+    :param policy RetentionPolicy: retention policy of the repository, defaults to 7 days from now
+    :return deletable_images list: deletable images followed by the artifacts that refer to them
+    """
+    policy = policy or RetentionPolicy.from_now()
+    mask = deletable_mask(images, k8s_images, policy)
+    if policy.keep_last:
+        for index in keep_last_indexes(images, policy):
+            # Repositories tagged for deletion lose every image, however recent
+            if not images[index].force_delete:
+                mask[index] = False
     deletable_images = []
     keepable_images = []
-    try:
-        config.load_kube_config()
-    except config.config_exception.ConfigException:
-        config.load_incluster_config()
+    for image, deletable in zip(images, mask):
+        if deletable:
+            deletable_images.append(image)
+            deletable_images.extend(artifact_index.get(image.digest, []))
+        else:
+            keepable_images.append(image.image_uri)
+    logger.debug(f"{keepable_images=}")
+    logger.debug(f"{deletable_images=}")
+    return deletable_images
 
-    minimum_image_age: int = int(os.getenv("MINIMUM_IMAGE_AGE", "7"))
-    client = boto3.client("ecr")
-    if os.getenv("AWS_REGISTRY_ID"):
-        registry_id = os.getenv("AWS_REGISTRY_ID")
-    else:
+
+def group_images_for_deletion(images: list) -> dict:
+    """
+    :param images list: images and artifacts that should be deleted
+
+    Groups images by the repository they live in so they can be removed with batch calls.
+    Duplicate digests inside a repository are only listed once.
+    :return groups dict: (registryId, repositoryName) mapped to a list of imageIds
+    """
+    groups = {}
+    seen = set()
+    for image in images:
+        key = (image.registry_id, image.repository_name)
+        if (key, image.digest) in seen:
+            continue
+        seen.add((key, image.digest))
+        groups.setdefault(key, []).append({"imageDigest": image.digest})
+    return groups
+
+
+def delete_images(client: boto3.client, images: list, dry_run: bool = False) -> list:
+    """
+    :param client boto3.client: configuration for boto3
+    :param images list: images and artifacts that should be deleted
+    :param dry_run bool: only log the batches that would be sent
+
+    Deletes images from ECR in batches of up to BATCH_DELETE_LIMIT digests per repository.
+    Digests that come back in the failures list are retried, except for failures that
+    can never succeed (e.g. the image is already gone). A call that fails outright fails
+    its whole batch the same way, after a jittered backoff, instead of ending the run.
+    :return failures list: failures that could not be resolved by retrying
+    """
+    unresolved = []
+    for (registry_id, repository_name), image_ids in group_images_for_deletion(
+        images
+    ).items():
+        batches = chunk(image_ids, BATCH_DELETE_LIMIT)
+        if dry_run:
+            for number, batch in enumerate(batches, start=1):
+                logger.info(
+                    f"DRY_RUN: batch {number}/{len(batches)} would delete {len(batch)} images from {registry_id}/{repository_name}: "
+                    f"{[image_id['imageDigest'] for image_id in batch]}"
+                )
+            continue
+
+        pending = image_ids
+        for attempt in range(1, BATCH_DELETE_ATTEMPTS + 1):
+            retryable = []
+            call_failed = False
+            for batch in chunk(pending, BATCH_DELETE_LIMIT):
+                logger.info(
+                    f"Deleting {len(batch)} images from {registry_id}/{repository_name} (attempt {attempt})"
+                )
+                try:
+                    response = client.batch_delete_image(
+                        registryId=registry_id,
+                        repositoryName=repository_name,
+                        imageIds=batch,
+                    )
+                except (ClientError, BotoCoreError) as e:
+                    # botocore already retried, record the batch and carry on with the run.
+                    # Connection errors and timeouts carry no response, only a message.
+                    error = (
+                        e.response.get("Error", {})
+                        if isinstance(e, ClientError)
+                        else {"Code": type(e).__name__, "Message": str(e)}
+                    )
+                    logger.warning(
+                        f"Deleting {len(batch)} images from {registry_id}/{repository_name} failed: {error.get('Code')} {error.get('Message')}"
+                    )
+                    call_failed = True
+                    response = {
+                        "failures": [
+                            {
+                                "imageId": image_id,
+                                "failureCode": error.get("Code"),
+                                "failureReason": error.get("Message"),
+                            }
+                            for image_id in batch
+                        ]
+                    }
+                for failure in response.get("failures", []):
+                    if failure.get("failureCode") in PERMANENT_DELETE_FAILURES:
+                        logger.info(
+                            f"Not retrying {failure['imageId']} in {repository_name}: {failure.get('failureCode')} {failure.get('failureReason')}"
+                        )
+                        continue
+                    retryable.append(failure)
+            if not retryable:
+                break
+            if attempt == BATCH_DELETE_ATTEMPTS:
+                for failure in retryable:
+                    logger.error(
+                        f"Unable to delete {failure['imageId']} from {repository_name}: {failure.get('failureCode')} {failure.get('failureReason')}"
+                    )
+                unresolved.extend(retryable)
+                break
+            if call_failed:
+                # Full jitter, so throttled workers don't retry in lockstep
+                time.sleep(random.uniform(0, DELETE_BACKOFF_BASE * 2 ** (attempt - 1)))
+            # Retry after the rest of the repository has been processed so failures such as
+            # ImageReferencedByManifestList can clear once the index itself is gone.
+            pending = [
+                {"imageDigest": failure["imageId"]["imageDigest"]}
+                for failure in retryable
+            ]
+    return unresolved
+
+
+@dataclass(slots=True)
+class SweepSettings:
+    """
+    Settings shared by every target of a run, read once from the environment.
+    """
+
+    policy: RetentionPolicy
+    policies: RetentionPolicyMatcher
+    scan_concurrency: int = 1
+    max_pool_connections: int = AWS_MAX_POOL_CONNECTIONS
+    max_attempts: int = AWS_MAX_ATTEMPTS
+    rate_limits: dict = field(default_factory=dict)
+    tag_discovery: str = "per-repository"
+    delete_unapproved: bool = False
+    tag_cache_path: str | None = None
+    tag_cache_ttl: int = TAG_CACHE_TTL
+    state_path: str | None = None
+    full_scan_interval: int = 7
+    subject_cache_path: str | None = None
+    subject_cache_max_entries: int = SUBJECT_CACHE_MAX_ENTRIES
+    dry_run: bool = False
+
+
+def parse_targets(value: str | None, default_registry_id: str | None = None) -> list:
+    """
+    :param value str: JSON list of targets, each with optional registry_id, region and role_arn
+    :param default_registry_id str: registry of the single target used when value is unset
+    :return targets list: target dicts
+    """
+    if not value:
+        return [{"registry_id": default_registry_id}]
+    targets = json.loads(value)
+    for target in targets:
+        unknown = set(target) - {"registry_id", "region", "role_arn"}
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in ECR target {target}")
+    return targets
+
+
+def target_label(target: dict) -> str:
+    """
+    :param target dict:
+    :return label str: account and region of the target for logs, reports and file names
+    """
+    account = target.get("registry_id")
+    if not account and target.get("role_arn"):
+        account = target["role_arn"].split(":")[4]
+    return f"{account or 'default'}/{target.get('region') or 'default'}"
+
+
+def target_path(path: str | None, target: dict, shared: bool) -> str | None:
+    """
+    :param path str: state or cache file configured for the run
+    :param target dict:
+    :param shared bool: whether several targets run, so each needs a file of its own
+    :return path str: path with the target label added before the extension when shared
+    """
+    if not path or not shared:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{re.sub(r'[^A-Za-z0-9_.-]', '-', target_label(target))}{extension}"
+
+
+def target_session(target: dict) -> boto3.Session:
+    """
+    :param target dict:
+    :return session boto3.Session: session in the target region, under the target role if one is set
+
+    The role is assumed on first use and again before its credentials expire, so a
+    controller or a long sweep keeps working past the session duration.
+    """
+    if not target.get("role_arn"):
+        return boto3.Session(region_name=target.get("region"))
+    source = botocore.session.get_session()
+    fetcher = AssumeRoleCredentialFetcher(
+        client_creator=source.create_client,
+        source_credentials=source.get_credentials(),
+        role_arn=target["role_arn"],
+        extra_args={"RoleSessionName": "ecr-image-cleanup"},
+    )
+    role = botocore.session.get_session()
+    role._credentials = DeferredRefreshableCredentials(
+        refresh_using=fetcher.fetch_credentials, method="assume-role"
+    )
+    return boto3.Session(botocore_session=role, region_name=target.get("region"))
+
+
+def run_target(
+    target: dict,
+    references,
+    settings: SweepSettings,
+    shared: bool = False,
+    metrics: RunMetrics | None = None,
+) -> dict:  # pragma: no cover
+    """
+    :param target dict: registry_id, region and role_arn of the registry to clean up
+    :param references ImageReferenceIndex: images referenced by workloads, shared by every target
+    :param settings SweepSettings:
+    :param shared bool: whether other targets run in the same process
+    :param metrics RunMetrics: metrics of the run, labelled with the target
+    Scans one registry and deletes its unused images.
+    :return report dict: what was found and deleted in the target
+    """
+    label = target_label(target)
+    metrics = metrics or RunMetrics()
+    session = target_session(target)
+    client, client_metrics = create_ecr_client(
+        settings.max_pool_connections,
+        settings.max_attempts,
+        settings.rate_limits,
+        session=session,
+    )
+    registry_id = target.get("registry_id")
+    if not registry_id:
         try:
             registry_id = client.describe_registry()["registryId"]
         except client.exceptions.ValidationException:
-            logger.error(
+            raise ValueError(
                 "GOV Cloud Doesn't support describe registry. Please add the environment variable AWS_REGISTRY_ID instead."
             )
-            sys.exit(1)
-    repositories = get_ecr_repositories(client, registry_id)
-    ecr_images, artifact_index = get_ecr_images(
-        client, registry_id, repositories, minimum_image_age
-    )
-    k8s_images = get_images_from_workloads()
-    for image in ecr_images:
-        logger.debug(f"{image=}")
-        if is_image_deletable(image, k8s_images):
-            deletable_images.append(image)
-            related_artifacts = artifact_index.get(image["imageDigest"], [])
-            if related_artifacts:
-                deletable_images.extend(related_artifacts)
+    tagging_client = None
+    if settings.delete_unapproved and settings.tag_discovery == "tagging-api":
+        tagging_client = session.client("resourcegroupstaggingapi")
+    with (
+        metrics.phase("repository_discovery", target=label),
+        metrics.profile("repository_discovery"),
+    ):
+        repositories = get_ecr_repositories(
+            client,
+            registry_id,
+            tagging_client,
+            target_path(settings.tag_cache_path, target, shared),
+            settings.tag_cache_ttl,
+            settings.scan_concurrency,
+            settings.delete_unapproved,
+        )
+    metrics.set("repositories", len(repositories), target=label)
+    scanned_repositories = repositories
+    fingerprints = {}
+    state_path = target_path(settings.state_path, target, shared)
+    if state_path:
+        now = settings.policy.reference_time
+        state = load_scan_state(state_path)
+        full_scan = is_full_scan_due(state, now, settings.full_scan_interval)
+        if full_scan:
+            logger.info(f"Running a full scan of every repository in {label}")
         else:
-            keepable_images.append(image["image_uri"])
+            # Repositories scanned anyway are fingerprinted from their describe_images pages
+            known = state.get("repositories", {})
+            candidates = [
+                repository
+                for repository in repositories
+                if not is_scan_due(repository, known, now)
+            ]
+            with (
+                metrics.phase("fingerprint", target=label),
+                metrics.profile("fingerprint"),
+            ):
+                fingerprints = get_repository_fingerprints(
+                    client, registry_id, candidates, settings.scan_concurrency
+                )
+            scanned_repositories = select_changed_repositories(
+                repositories, fingerprints, state, now
+            )
 
-    logger.debug(f"{keepable_images=}")
-    logger.debug(f"{deletable_images=}")
-    for image in deletable_images:
-        delete_image(client, image)
+    # The cache prunes by repository name, which other accounts may use too
+    subject_cache = None
+    if settings.subject_cache_path:
+        subject_cache = SubjectCache(
+            target_path(settings.subject_cache_path, target, shared),
+            settings.subject_cache_max_entries,
+        )
+    boundaries = {}
+    pending_repositories = set()
+    deletable_count = 0
+    reclaimed_bytes = 0
+    unresolved = []
+    # Scans run on workers, so each step is profiled on the thread running it and the
+    # whole sweep only takes the allocation snapshots
+    with metrics.profile("sweep", functions=False):
+        for repository, (images, artifact_index, stats, fingerprint) in zip(
+            scanned_repositories,
+            iter_ecr_images(
+                client,
+                registry_id,
+                scanned_repositories,
+                settings.policy,
+                settings.scan_concurrency,
+                subject_cache,
+                metrics,
+            ),
+        ):
+            fingerprints[repository["repository_name"]] = fingerprint
+            for phase in ("scan", "artifact_resolution"):
+                metrics.inc(
+                    "phase_seconds",
+                    stats[f"{phase}_seconds"],
+                    phase=phase,
+                    target=label,
+                )
+            if not images:
+                continue
+            metrics.inc("images_evaluated_total", len(images), target=label)
+            repository_policy = settings.policies.policy_for(images[0].repository_name)
+            with (
+                metrics.phase("evaluation", target=label),
+                metrics.profile("evaluation", allocations=False),
+            ):
+                deletable_images = evaluate_repository(
+                    images, artifact_index, references, repository_policy
+                )
+            if deletable_images:
+                pending_repositories.add(deletable_images[0].repository_name)
+                deletable_count += len(deletable_images)
+                with (
+                    metrics.phase("deletion", target=label),
+                    metrics.profile("deletion", allocations=False),
+                ):
+                    failures = delete_images(
+                        client, deletable_images, dry_run=settings.dry_run
+                    )
+                unresolved.extend(failures)
+                # Artifacts of several subjects may be listed twice, they are deleted once
+                sizes = {image.digest: image.size or 0 for image in deletable_images}
+                metrics.inc("images_deletable_total", len(sizes), target=label)
+                metrics.inc("bytes_deletable_total", sum(sizes.values()), target=label)
+                if not settings.dry_run:
+                    for failure in failures:
+                        sizes.pop(failure["imageId"].get("imageDigest"), None)
+                    reclaimed_bytes += sum(sizes.values())
+                    metrics.inc("images_deleted_total", len(sizes), target=label)
+                    metrics.inc(
+                        "bytes_reclaimed_total", sum(sizes.values()), target=label
+                    )
+            if state_path:
+                boundaries.update(next_retention_boundaries(images, repository_policy))
+    if subject_cache:
+        subject_cache.close()
+    log_client_metrics(client_metrics)
+    metrics.add_client_metrics(client_metrics, target=label)
+
+    if state_path:
+        save_scan_state(
+            state_path,
+            update_scan_state(
+                state,
+                repositories,
+                scanned_repositories,
+                fingerprints,
+                boundaries,
+                pending_repositories,
+                now,
+                full_scan,
+            ),
+        )
+    return {
+        "target": label,
+        "registry_id": registry_id,
+        "repositories": len(repositories),
+        "scanned_repositories": len(scanned_repositories),
+        "deletable_images": deletable_count,
+        "unresolved_failures": len(unresolved),
+        "reclaimed_bytes": reclaimed_bytes,
+        "api": client_metrics.summary(),
+    }
+
+
+def combine_reports(reports: list) -> dict:
+    """
+    :param reports list: reports of every target, failed targets carry an error instead of counts
+    :return report dict: per target reports and their totals
+    """
+    totals = Counter()
+    for report in reports:
+        for key in (
+            "repositories",
+            "scanned_repositories",
+            "deletable_images",
+            "unresolved_failures",
+            "reclaimed_bytes",
+        ):
+            totals[key] += report.get(key, 0)
+    totals["failed_targets"] = sum("error" in report for report in reports)
+    return {"targets": reports, "totals": dict(totals)}
+
+
+def settings_from_env() -> SweepSettings:  # pragma: no cover
+    """
+    Reads the settings of a sweep from the environment. The retention policy is built
+    here, so each sweep gets its own reference time.
+    :return settings SweepSettings:
+    """
+    minimum_image_age: int = int(os.getenv("MINIMUM_IMAGE_AGE", "7"))
+    policy = RetentionPolicy.from_now(
+        push_window_days=int(os.getenv("MINIMUM_PUSH_AGE", minimum_image_age)),
+        pull_window_days=int(os.getenv("MINIMUM_PULL_AGE", minimum_image_age)),
+    )
+    scan_concurrency: int = int(os.getenv("SCAN_CONCURRENCY", "1"))
+    return SweepSettings(
+        policy=policy,
+        policies=load_retention_policies(os.getenv("RETENTION_POLICY_FILE"), policy),
+        scan_concurrency=scan_concurrency,
+        # boto3 clients are thread safe, but the connection pool has to fit every scan worker
+        max_pool_connections=int(
+            os.getenv(
+                "AWS_MAX_POOL_CONNECTIONS",
+                str(max(AWS_MAX_POOL_CONNECTIONS, scan_concurrency)),
+            )
+        ),
+        max_attempts=int(os.getenv("AWS_MAX_ATTEMPTS", str(AWS_MAX_ATTEMPTS))),
+        rate_limits=parse_rate_limits(os.getenv("ECR_RATE_LIMITS")),
+        tag_discovery=os.getenv("TAG_DISCOVERY", "per-repository"),
+        delete_unapproved=bool(os.getenv("DELETE_UNAPPROVED_REPOSITORIES")),
+        tag_cache_path=os.getenv("TAG_CACHE_PATH"),
+        tag_cache_ttl=int(os.getenv("TAG_CACHE_TTL", str(TAG_CACHE_TTL))),
+        state_path=os.getenv("INCREMENTAL_STATE_PATH"),
+        full_scan_interval=int(os.getenv("FULL_SCAN_INTERVAL", "7")),
+        subject_cache_path=os.getenv("SUBJECT_CACHE_PATH"),
+        subject_cache_max_entries=int(
+            os.getenv("SUBJECT_CACHE_MAX_ENTRIES", str(SUBJECT_CACHE_MAX_ENTRIES))
+        ),
+        dry_run=bool(os.getenv("DRY_RUN")),
+    )
+
+
+def sweep(
+    targets: list, references, settings: SweepSettings, metrics: RunMetrics
+) -> dict:  # pragma: no cover
+    """
+    :param targets list: registries to clean up
+    :param references ImageReferenceIndex: images referenced by workloads
+    :param settings SweepSettings:
+    :param metrics RunMetrics: metrics of the run, exported once every target is done
+    Cleans up every target concurrently against the same references.
+    :return report dict: combined report of every target
+    """
+    shared = len(targets) > 1
+    reports = []
+    target_concurrency = int(os.getenv("TARGET_CONCURRENCY", str(len(targets))))
+    with ThreadPoolExecutor(max_workers=max(1, target_concurrency)) as executor:
+        futures = {
+            executor.submit(
+                run_target, target, references, settings, shared, metrics
+            ): target
+            for target in targets
+        }
+        for future in as_completed(futures):
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                # One unreachable account shouldn't stop the sweep of the others
+                logger.error(f"Cleaning up {target_label(futures[future])} failed: {e}")
+                reports.append(
+                    {"target": target_label(futures[future]), "error": str(e)}
+                )
+
+    report = combine_reports(sorted(reports, key=lambda report: report["target"]))
+    logger.info(f"Run report: {json.dumps(report['totals'])}")
+    if os.getenv("REPORT_PATH"):
+        with open(os.getenv("REPORT_PATH"), "w") as f:
+            json.dump(report, f, indent=2)
+    metrics.set("failed_targets", report["totals"]["failed_targets"])
+    metrics.set("last_run_timestamp_seconds", time.time())
+    emit_metrics(metrics)
+    if metrics.profiler:
+        metrics.profiler.write_report()
+    return report
+
+
+def run_controller(
+    targets: list, kube_contexts: list, page_size: int
+) -> None:  # pragma: no cover
+    """
+    :param targets list: registries to clean up
+    :param kube_contexts list: kubeconfig contexts to watch, the loaded config if empty
+    :param page_size int: number of objects requested per list call
+    Keeps the workload references warm with watches and sweeps every SWEEP_INTERVAL
+    seconds against a snapshot of them, without listing workloads again. A sweep is
+    skipped while any watch is out of sync.
+    """
+    interval = int(os.getenv("SWEEP_INTERVAL", str(SWEEP_INTERVAL)))
+    stop = threading.Event()
+    cache = ReferenceCache()
+    informers = start_informers(cache, kube_contexts, page_size, stop)
+    # A sweep before every kind is listed would take images of unlisted kinds as unused
+    for informer in informers:
+        informer.synced.wait()
+    logger.info(f"Watching {len(informers)} workload kinds, sweeping every {interval}s")
+    while not stop.is_set():
+        metrics = RunMetrics()
+        if not informers_synced(informers, metrics):
+            emit_metrics(metrics)
+            stop.wait(interval)
+            continue
+        # Only a sweep writes the report that stops tracemalloc, so profile after the check
+        if os.getenv("PROFILE_DIR"):
+            metrics.profiler = Profiler(os.getenv("PROFILE_DIR"))
+        with metrics.phase("workload_inventory"), metrics.profile("workload_inventory"):
+            references = cache.snapshot()
+        logger.info(f"Indexed {len(references)} image references from workloads")
+        sweep(targets, references, settings_from_env(), metrics)
+        stop.wait(interval)
+
+
+def main():  # pragma: no cover
+    kube_contexts = [
+        context.strip()
+        for context in os.getenv("KUBE_CONTEXTS", "").split(",")
+        if context.strip()
+    ]
+    if not kube_contexts:
+        try:
+            config.load_kube_config()
+        except config.config_exception.ConfigException:
+            config.load_incluster_config()
+
+    targets = parse_targets(os.getenv("ECR_TARGETS"), os.getenv("AWS_REGISTRY_ID"))
+    k8s_page_size = int(os.getenv("K8S_PAGE_SIZE", str(K8S_PAGE_SIZE)))
+    if os.getenv("RUN_MODE", "job") == "controller":
+        run_controller(targets, kube_contexts, k8s_page_size)
+        return
+    settings = settings_from_env()
+
+    # The reference index is built once, before any target, so every repository can be
+    # decided as soon as it is scanned
+    profiler = Profiler(os.getenv("PROFILE_DIR")) if os.getenv("PROFILE_DIR") else None
+    metrics = RunMetrics(profiler)
+    # The kinds are listed on workers, which profile their own calls
+    with (
+        metrics.phase("workload_inventory"),
+        metrics.profile("workload_inventory", functions=False),
+    ):
+        if kube_contexts:
+            k8s_images = get_images_from_clusters(kube_contexts, k8s_page_size, metrics)
+        else:
+            k8s_images = get_images_from_workloads(k8s_page_size, metrics=metrics)
+        references = ImageReferenceIndex(k8s_images)
+    del k8s_images
+    logger.info(f"Indexed {len(references)} image references from workloads")
+
+    report = sweep(targets, references, settings, metrics)
+    if report["totals"]["failed_targets"]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":  # pragma: no cover
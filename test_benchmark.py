@@ -0,0 +1,50 @@
+from unittest import mock
+
+import benchmark
+import main
+import pytest
+
+
+def test_run_benchmark_smoke():
+    # Skip the retry backoff of throttled requests
+    with mock.patch("time.sleep"):
+        results = benchmark.run_benchmark(
+            repositories=3, images=20, pods=30, throttle_rate=0.2, concurrency=2
+        )
+    assert [phase["phase"] for phase in results["phases"]] == [
+        "workloads",
+        "index",
+        "target",
+    ]
+    assert {"repository_discovery", "scan", "evaluation", "deletion"} <= set(
+        results["breakdown"]
+    )
+    assert results["images_evaluated"] == 60
+    target = results["phases"][-1]
+    assert results["api"]["DescribeImages"]["calls"] == 3
+    assert target["peak_memory_bytes"] > 0
+    assert 0 < results["images_deleted"]
+
+
+def test_throttled_requests_are_retried_by_botocore():
+    # The first request of this seed is throttled and the second one goes through
+    ecr = benchmark.FakeECR(1, 1, throttle_rate=0.5, seed=1)
+    client, client_metrics = main.create_ecr_client(
+        session=benchmark.boto3.Session(
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+            region_name=benchmark.REGION,
+        )
+    )
+    ecr.attach(client)
+    with mock.patch("time.sleep"):
+        assert client.describe_registry()["registryId"] == benchmark.REGISTRY_ID
+    summary = client_metrics.summary()["DescribeRegistry"]
+    assert (summary["calls"], summary["retries"], summary["throttles"]) == (1, 1, 1)
+    assert ecr.calls["DescribeRegistry"] == 2
+
+
+@pytest.mark.parametrize("throttle_rate", [-0.1, 1.0, 2.0])
+def test_fake_ecr_rejects_throttle_rates_that_never_succeed(throttle_rate):
+    with pytest.raises(ValueError):
+        benchmark.FakeECR(1, 1, throttle_rate=throttle_rate)
@@ -1,86 +1,39 @@
+import json
+import random
+from collections import Counter
 from datetime import datetime, timedelta
 
+import boto3
 import main
 import pytest
 import pytz
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
 
 UTC = pytz.UTC
 
 
+def record(image: dict) -> main.ImageRecord:
+    # Builds an ImageRecord from a describe_images style dict, image_uri names the repository
+    repository = {
+        "registry_id": image.get("registryId"),
+        "repository_name": image.get("repositoryName"),
+        "repository_uri": image.get("image_uri", "repo"),
+        "delete": image.get("force_delete", False),
+    }
+    return main.ImageRecord.from_image({"imageDigest": None, **image}, repository)
+
+
 @pytest.mark.parametrize(
-    "image,repository,result",
+    "image,result",
     [
-        (
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "imageTags": ["test"],
-            },
-            {"repository_uri": "testing"},
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "imageTags": ["test"],
-                "image_uri": "testing:test",
-            },
-        ),
-        (
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "imageDigest": "digest",
-            },
-            {"repository_uri": "testing"},
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "imageDigest": "digest",
-                "image_uri": "testing@digest",
-            },
-        ),
-        (
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "artifactMediaType": "application/vnd.oci.image.config.v1+json",
-                "imageTags": ["test"],
-            },
-            {"repository_uri": "testing"},
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "artifactMediaType": "application/vnd.oci.image.config.v1+json",
-                "imageTags": ["test"],
-                "image_uri": "testing:test",
-            },
-        ),
-        (
-            {
-                "imageManifestMediaType": "test",
-                "imageTags": ["test"],
-            },
-            {"repository_uri": "testing"},
-            None,
-        ),
-        (
-            {
-                "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                "artifactMediaType": "application/vnd.dev.cosign.simplesigning.v1+json",
-                "imageTags": ["test"],
-            },
-            {"repository_uri": "testing"},
-            None,
-        ),
-        (
-            {
-                "imageManifestMediaType": "application/vnd.oci.image.manifest.v1+json",
-                "imageTags": ["test"],
-            },
-            {"repository_uri": "testing"},
-            {
-                "imageManifestMediaType": "application/vnd.oci.image.manifest.v1+json",
-                "imageTags": ["test"],
-                "image_uri": "testing:test",
-            },
-        ),
+        ({"imageTags": ["test", "latest"], "imageDigest": "digest"}, "testing:test"),
+        ({"imageDigest": "digest"}, "testing@digest"),
+        ({}, "testing"),
     ],
 )
-def test_build_image_uri(image, repository, result):
-    assert (main.build_image_uri(image, repository)) == result
+def test_image_record_image_uri(image, result):
+    assert record({"image_uri": "testing", **image}).image_uri == result
 
 
 @pytest.mark.parametrize(
@@ -147,77 +100,6 @@ def test_extract_subject_digest(manifest, result):
     assert main.extract_subject_digest(manifest) == result
 
 
-@pytest.mark.parametrize(
-    "image,imageDetails,repository,result",
-    [
-        (
-            [],
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                    "imageTags": ["test"],
-                }
-            ],
-            {"repository_uri": "testing"},
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                    "imageTags": ["test"],
-                    "image_uri": "testing:test",
-                }
-            ],
-        ),
-        (
-            [],
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                    "imageDigest": "digest",
-                }
-            ],
-            {"repository_uri": "testing"},
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.docker.distribution.manifest.v2+json",
-                    "imageDigest": "digest",
-                    "image_uri": "testing@digest",
-                }
-            ],
-        ),
-        (
-            [],
-            [
-                {
-                    "imageManifestMediaType": "test",
-                    "imageTags": ["test"],
-                }
-            ],
-            {"repository_uri": "testing"},
-            [],
-        ),
-        (
-            [],
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.oci.image.manifest.v1+json",
-                    "imageTags": ["test"],
-                }
-            ],
-            {"repository_uri": "testing"},
-            [
-                {
-                    "imageManifestMediaType": "application/vnd.oci.image.manifest.v1+json",
-                    "imageTags": ["test"],
-                    "image_uri": "testing:test",
-                }
-            ],
-        ),
-    ],
-)
-def test_append_image(image, imageDetails, repository, result):
-    assert (main.append_image(image, imageDetails, repository)) == result
-
-
 @pytest.mark.parametrize(
     "image,result",
     [
@@ -240,7 +122,7 @@ def test_append_image(image, imageDetails, repository, result):
     ],
 )
 def test_is_image_pulled_recently(image, result):
-    assert (main.is_image_pulled_recently(image)) == result
+    assert (main.is_image_pulled_recently(record(image))) == result
 
 
 @pytest.mark.parametrize(
@@ -265,7 +147,7 @@ def test_is_image_pulled_recently(image, result):
     ],
 )
 def test_is_image_pushed_recently(image, result):
-    assert (main.is_image_pushed_recently(image)) == result
+    assert (main.is_image_pushed_recently(record(image))) == result
 
 
 @pytest.mark.parametrize(
@@ -288,7 +170,7 @@ def test_is_image_pushed_recently(image, result):
 def test_is_image_tagged_keep(image, result):
     assert (
         main.is_image_tagged_keep(
-            image,
+            record(image),
         )
     ) == result
 
@@ -309,7 +191,7 @@ def test_is_image_tagged_keep(image, result):
     ],
 )
 def test_is_image_referenced(image, images, result):
-    assert (main.is_image_referenced(image, images)) == result
+    assert (main.is_image_referenced(record(image), images)) == result
 
 
 @pytest.mark.parametrize(
@@ -336,4 +218,1347 @@ def test_is_image_referenced(image, images, result):
     ],
 )
 def test_is_image_deletable(image, images, result):
-    assert (main.is_image_deletable(image, images)) == result
+    assert (main.is_image_deletable(record(image), images)) == result
+
+
+@pytest.mark.parametrize(
+    "items,size,result",
+    [
+        ([1, 2, 3], 2, [[1, 2], [3]]),
+        ([1, 2], 2, [[1, 2]]),
+        ([], 2, []),
+    ],
+)
+def test_chunk(items, size, result):
+    assert main.chunk(items, size) == result
+
+
+@pytest.mark.parametrize(
+    "images,result",
+    [
+        (
+            [
+                {"registryId": "1", "repositoryName": "a", "imageDigest": "d1"},
+                {"registryId": "1", "repositoryName": "b", "imageDigest": "d2"},
+                {"registryId": "1", "repositoryName": "a", "imageDigest": "d3"},
+                {"registryId": "1", "repositoryName": "a", "imageDigest": "d1"},
+            ],
+            {
+                ("1", "a"): [{"imageDigest": "d1"}, {"imageDigest": "d3"}],
+                ("1", "b"): [{"imageDigest": "d2"}],
+            },
+        ),
+        ([], {}),
+    ],
+)
+def test_group_images_for_deletion(images, result):
+    assert main.group_images_for_deletion([record(image) for image in images]) == result
+
+
+class FakeDeleteClient:
+    def __init__(self, failures):
+        # failures is a list of failure lists to return on successive calls
+        self.failures = failures
+        self.calls = []
+
+    def batch_delete_image(self, registryId, repositoryName, imageIds):
+        self.calls.append([image_id["imageDigest"] for image_id in imageIds])
+        failures = self.failures.pop(0) if self.failures else []
+        return {"imageIds": imageIds, "failures": failures}
+
+
+def test_delete_images_batches_and_retries_failures():
+    images = [
+        record({"registryId": "1", "repositoryName": "a", "imageDigest": f"d{i}"})
+        for i in range(150)
+    ]
+    client = FakeDeleteClient(
+        [
+            [
+                {
+                    "imageId": {"imageDigest": "d1"},
+                    "failureCode": "ImageReferencedByManifestList",
+                },
+                {"imageId": {"imageDigest": "d2"}, "failureCode": "ImageNotFound"},
+            ],
+        ]
+    )
+    assert main.delete_images(client, images) == []
+    assert [len(call) for call in client.calls] == [100, 50, 1]
+    assert client.calls[2] == ["d1"]
+
+
+def test_delete_images_reports_unresolved_failures():
+    failure = {"imageId": {"imageDigest": "d0"}, "failureCode": "KmsError"}
+    client = FakeDeleteClient([[failure]] * main.BATCH_DELETE_ATTEMPTS)
+    images = [record({"registryId": "1", "repositoryName": "a", "imageDigest": "d0"})]
+    assert main.delete_images(client, images) == [failure]
+    assert len(client.calls) == main.BATCH_DELETE_ATTEMPTS
+
+
+def test_delete_images_dry_run():
+    client = FakeDeleteClient([])
+    images = [record({"registryId": "1", "repositoryName": "a", "imageDigest": "d0"})]
+    assert main.delete_images(client, images, dry_run=True) == []
+    assert client.calls == []
+
+
+class FakeBatchGetClient:
+    class exceptions:
+        class ImageNotFoundException(Exception):
+            pass
+
+    def __init__(self, manifests):
+        self.manifests = manifests
+        self.calls = []
+
+    def batch_get_image(self, registryId, repositoryName, imageIds, acceptedMediaTypes):
+        self.calls.append((acceptedMediaTypes[0], len(imageIds)))
+        images, failures = [], []
+        for image_id in imageIds:
+            digest = image_id["imageDigest"]
+            if digest in self.manifests:
+                images.append(
+                    {"imageId": image_id, "imageManifest": self.manifests[digest]}
+                )
+            else:
+                failures.append({"imageId": image_id, "failureCode": "ImageNotFound"})
+        return {"images": images, "failures": failures}
+
+
+def test_get_artifact_subject_digests_batches_per_media_type():
+    signature = "application/vnd.oci.image.manifest.v1+json"
+    sbom = "application/vnd.docker.distribution.manifest.v2+json"
+    artifacts = [
+        {"imageDigest": f"sha256:sig{i}", "imageManifestMediaType": signature}
+        for i in range(150)
+    ] + [
+        {"imageDigest": "sha256:sbom", "imageManifestMediaType": sbom},
+        {"imageDigest": "sha256:gone", "imageManifestMediaType": sbom},
+        {"imageDigest": "sha256:untyped"},
+    ]
+    manifests = {
+        artifact["imageDigest"]: '{"subject": {"digest": "sha256:image"}}'
+        for artifact in artifacts
+        if artifact["imageDigest"] != "sha256:gone"
+    }
+    client = FakeBatchGetClient(manifests)
+    subjects = main.get_artifact_subject_digests(
+        client, "1", {"repository_name": "a"}, artifacts
+    )
+    assert client.calls == [(signature, 100), (signature, 50), (sbom, 2)]
+    assert len(subjects) == 151
+    assert "sha256:gone" not in subjects
+    assert "sha256:untyped" not in subjects
+
+
+@pytest.mark.parametrize(
+    "tags,result",
+    [
+        (["sha256-" + "a" * 64 + ".sig"], "sha256:" + "a" * 64),
+        (["latest", "sha256-" + "b" * 64 + ".att"], "sha256:" + "b" * 64),
+        (["sha256-" + "c" * 64 + ".sbom"], "sha256:" + "c" * 64),
+        (["sha256-" + "c" * 64 + ".other"], None),
+        (["sha256-abc.sig"], None),
+        ([], None),
+    ],
+)
+def test_subject_digest_from_tags(tags, result):
+    assert main.subject_digest_from_tags(tags) == result
+
+
+def test_resolve_artifact_subjects_skips_manifest_fetch_for_cosign_tags():
+    media_type = "application/vnd.oci.image.manifest.v1+json"
+    artifacts = [
+        {
+            "imageDigest": "sha256:sig",
+            "imageTags": ["sha256-" + "a" * 64 + ".sig"],
+            "imageManifestMediaType": media_type,
+        },
+        {"imageDigest": "sha256:untagged", "imageManifestMediaType": media_type},
+    ]
+    client = FakeBatchGetClient(
+        {"sha256:untagged": '{"subject": {"digest": "sha256:image"}}'}
+    )
+    subjects, stats = main.resolve_artifact_subjects(
+        client, "1", {"repository_name": "a"}, artifacts
+    )
+    assert subjects == {
+        "sha256:sig": "sha256:" + "a" * 64,
+        "sha256:untagged": "sha256:image",
+    }
+    assert client.calls == [(media_type, 1)]
+    assert stats == Counter(
+        subject_tag_hits=1, subject_tag_misses=1, subject_manifest_fetches=1
+    )
+
+
+def test_subject_cache_round_trip_prune_and_evict(tmp_path):
+    cache = main.SubjectCache(str(tmp_path / "subjects.db"), max_entries=2)
+    cache.put_many(
+        "repo",
+        {"sha256:a": "sha256:image", "sha256:b": None, "sha256:c": "sha256:image"},
+        {"sha256:a": "application/vnd.oci.image.manifest.v1+json"},
+    )
+    assert cache.get_many("repo", ["sha256:a", "sha256:b", "sha256:x"]) == {
+        "sha256:a": "sha256:image",
+        "sha256:b": None,
+    }
+    assert cache.get_many("other", ["sha256:a"]) == {}
+    assert cache.prune("repo", {"sha256:a", "sha256:c"}) == 1
+    assert cache.evict() == 0
+    cache.put_many("repo", {"sha256:d": None}, {})
+    assert cache.evict() == 1
+    assert len(cache.get_many("repo", ["sha256:a", "sha256:c", "sha256:d"])) == 2
+    cache.close()
+
+
+def test_resolve_artifact_subjects_warm_cache_skips_fetch(tmp_path):
+    media_type = "application/vnd.oci.image.manifest.v1+json"
+    artifacts = [
+        {"imageDigest": "sha256:untagged", "imageManifestMediaType": media_type},
+        {"imageDigest": "sha256:nosubject", "imageManifestMediaType": media_type},
+    ]
+    client = FakeBatchGetClient(
+        {
+            "sha256:untagged": '{"subject": {"digest": "sha256:image"}}',
+            "sha256:nosubject": "{}",
+        }
+    )
+    cache = main.SubjectCache(str(tmp_path / "subjects.db"))
+    cold, _ = main.resolve_artifact_subjects(
+        client, "1", {"repository_name": "a"}, artifacts, cache
+    )
+    warm, stats = main.resolve_artifact_subjects(
+        client, "1", {"repository_name": "a"}, artifacts, cache
+    )
+    assert cold == warm == {"sha256:untagged": "sha256:image", "sha256:nosubject": None}
+    assert client.calls == [(media_type, 2)]
+    assert stats["subject_cache_hits"] == 2
+    cache.close()
+
+
+def test_image_set_fingerprint_matches_list_and_describe_images():
+    listed = [
+        {"imageDigest": "sha256:a", "imageTag": "latest"},
+        {"imageDigest": "sha256:a", "imageTag": "v1"},
+        {"imageDigest": "sha256:b"},
+    ]
+    described = [
+        {"imageDigest": "sha256:b"},
+        {"imageDigest": "sha256:a", "imageTags": ["v1", "latest"]},
+    ]
+    assert main.image_set_fingerprint(listed) == main.image_set_fingerprint(described)
+    moved = [{"imageDigest": "sha256:b", "imageTags": ["latest"]}]
+    assert main.image_set_fingerprint(moved) != main.image_set_fingerprint(described)
+
+
+class FakeDescribeClient:
+    def __init__(self, pages):
+        self.pages = pages
+        self.operations = []
+
+    def get_paginator(self, name):
+        self.operations.append(name)
+        return FakePaginator([{"imageDetails": page} for page in self.pages])
+
+
+def test_scan_repository_fingerprints_described_pages():
+    media_type = "application/vnd.docker.distribution.manifest.v2+json"
+    pages = [
+        [
+            {
+                "imageDigest": "sha256:a",
+                "imageTags": ["latest", "v1"],
+                "imageManifestMediaType": media_type,
+                "imagePushedAt": datetime(2020, 1, 1, tzinfo=pytz.utc),
+            }
+        ],
+        [{"imageDigest": "sha256:b", "imageManifestMediaType": media_type}],
+    ]
+    client = FakeDescribeClient(pages)
+    repository = {
+        "repository_name": "repo",
+        "repository_uri": "ecr/repo",
+        "delete": True,
+    }
+    images, _, _, fingerprint = main.scan_repository(
+        client, "1", repository, main.RetentionPolicy.from_now()
+    )
+    assert [image.digest for image in images] == ["sha256:a", "sha256:b"]
+    assert fingerprint == main.image_set_fingerprint(
+        [
+            {"imageDigest": "sha256:a", "imageTag": "latest"},
+            {"imageDigest": "sha256:a", "imageTag": "v1"},
+            {"imageDigest": "sha256:b"},
+        ]
+    )
+    assert client.operations == ["describe_images"]
+
+
+def test_next_retention_boundaries():
+    now = datetime(2024, 1, 10, tzinfo=UTC)
+    images = [
+        {"repositoryName": "a", "imagePushedAt": now - timedelta(2)},
+        {
+            "repositoryName": "a",
+            "imagePushedAt": now - timedelta(30),
+            "lastRecordedPullTime": now - timedelta(5),
+        },
+        {"repositoryName": "b", "imagePushedAt": now - timedelta(30)},
+    ]
+    images = [record(image) for image in images]
+    policy = main.RetentionPolicy(int(now.timestamp()))
+    assert main.next_retention_boundaries(images, policy) == {
+        "a": (now + timedelta(2)).timestamp()
+    }
+
+
+def test_next_retention_boundaries_separate_windows():
+    now = datetime(2024, 1, 10, tzinfo=UTC)
+    images = [
+        record(
+            {
+                "repositoryName": "a",
+                "imagePushedAt": now - timedelta(2),
+                "lastRecordedPullTime": now - timedelta(1),
+            }
+        )
+    ]
+    policy = main.RetentionPolicy(int(now.timestamp()), 3, 30)
+    assert main.next_retention_boundaries(images, policy) == {
+        "a": (now + timedelta(29)).timestamp()
+    }
+
+
+def test_retention_policy_cutoffs():
+    policy = main.RetentionPolicy(86400 * 100, push_window_days=7, pull_window_days=30)
+    assert policy.push_cutoff == 86400 * 93
+    assert policy.pull_cutoff == 86400 * 70
+
+
+def test_retention_policy_windows_are_separate():
+    now = datetime(2024, 1, 10, tzinfo=UTC)
+    image = record(
+        {
+            "imagePushedAt": now - timedelta(10),
+            "lastRecordedPullTime": now - timedelta(10),
+        }
+    )
+    policy = main.RetentionPolicy(int(now.timestamp()), 7, 14)
+    assert not main.is_image_pushed_recently(image, policy)
+    assert main.is_image_pulled_recently(image, policy)
+    assert not main.is_image_deletable(image, main.ImageReferenceIndex(), policy)
+
+
+@pytest.mark.parametrize(
+    "state,now,result",
+    [
+        ({}, 0, True),
+        ({"last_full_scan": 0}, 86400 * 6, False),
+        ({"last_full_scan": 0}, 86400 * 7, True),
+    ],
+)
+def test_is_full_scan_due(state, now, result):
+    assert main.is_full_scan_due(state, now, 7) == result
+
+
+def test_select_changed_repositories():
+    repositories = [
+        {"repository_name": "unchanged"},
+        {"repository_name": "changed"},
+        {"repository_name": "new"},
+        {"repository_name": "boundary"},
+        {"repository_name": "unapproved", "delete": True},
+    ]
+    fingerprints = {repository["repository_name"]: "fp" for repository in repositories}
+    state = {
+        "repositories": {
+            "unchanged": {"fingerprint": "fp", "next_boundary": 200},
+            "changed": {"fingerprint": "old", "next_boundary": None},
+            "boundary": {"fingerprint": "fp", "next_boundary": 50},
+            "unapproved": {"fingerprint": "fp", "next_boundary": None},
+        }
+    }
+    assert [
+        main.is_scan_due(repository, state["repositories"], 100)
+        for repository in repositories
+    ] == [False, False, True, True, True]
+    selected = main.select_changed_repositories(repositories, fingerprints, state, 100)
+    assert [repository["repository_name"] for repository in selected] == [
+        "changed",
+        "new",
+        "boundary",
+        "unapproved",
+    ]
+
+
+def test_update_scan_state():
+    state = {
+        "last_full_scan": 10,
+        "repositories": {
+            "skipped": {"fingerprint": "fp", "next_boundary": None},
+            "removed": {"fingerprint": "fp", "next_boundary": None},
+        },
+    }
+    repositories = [
+        {"repository_name": "skipped"},
+        {"repository_name": "scanned"},
+        {"repository_name": "pending"},
+    ]
+    new_state = main.update_scan_state(
+        state,
+        repositories,
+        repositories[1:],
+        {"scanned": "fp1", "pending": "fp2"},
+        {"scanned": 500},
+        {"pending"},
+        100,
+        False,
+    )
+    assert new_state == {
+        "last_run": 100,
+        "last_full_scan": 10,
+        "repositories": {
+            "skipped": {"fingerprint": "fp", "next_boundary": None},
+            "scanned": {"fingerprint": "fp1", "next_boundary": 500},
+        },
+    }
+
+
+def test_scan_state_round_trip(tmp_path):
+    path = str(tmp_path / "state.json")
+    assert main.load_scan_state(path) == {}
+    main.save_scan_state(path, {"last_run": 1})
+    assert main.load_scan_state(path) == {"last_run": 1}
+
+
+@pytest.mark.parametrize(
+    "pod_spec,result",
+    [
+        (
+            {
+                "initContainers": [{"image": "init:1"}],
+                "containers": [{"image": "app:1"}, {"image": "sidecar:1"}],
+            },
+            {"init:1", "app:1", "sidecar:1"},
+        ),
+        ({"containers": [{"image": "app:1"}], "initContainers": None}, {"app:1"}),
+        ({}, set()),
+    ],
+)
+def test_extract_pod_spec_images(pod_spec, result):
+    assert main.extract_pod_spec_images(pod_spec) == result
+
+
+def test_extract_pod_status_images():
+    digest = "sha256:" + "a" * 64
+    pod_status = {
+        "initContainerStatuses": [
+            {"imageID": f"docker-pullable://{ECR}/init@{digest}"}
+        ],
+        "containerStatuses": [
+            {"imageID": f"{ECR}/app@{digest}"},
+            {"imageID": digest},
+            {"imageID": ""},
+            {},
+        ],
+    }
+    assert main.extract_pod_status_images(pod_status) == {
+        f"{ECR}/init@{digest}",
+        f"{ECR}/app@{digest}",
+    }
+
+
+def test_moved_tag_is_referenced_by_running_digest():
+    digest = "sha256:" + "b" * 64
+    pod = {
+        "spec": {"containers": [{"image": f"{ECR}/app:latest"}]},
+        "status": {"containerStatuses": [{"imageID": f"{ECR}/app@{digest}"}]},
+    }
+    images = main.list_workload_images(FakeLister([[pod]]), ("spec",), page_size=10)
+    old_image = record(
+        {"image_uri": f"{ECR}/app", "imageTags": ["v1"], "imageDigest": digest}
+    )
+    assert main.ImageReferenceIndex(images).references_image(old_image)
+
+
+class FakeListResponse:
+    def __init__(self, page):
+        self.data = json.dumps(page).encode()
+
+
+class FakeLister:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def __call__(self, limit, _preload_content, _continue=None):
+        self.calls.append((limit, _continue))
+        index = int(_continue) if _continue else 0
+        page = {"metadata": {}, "items": self.pages[index]}
+        if index + 1 < len(self.pages):
+            page["metadata"]["continue"] = str(index + 1)
+        return FakeListResponse(page)
+
+
+def test_list_workload_images_follows_continue_tokens():
+    def cronjob(image):
+        return {
+            "spec": {
+                "jobTemplate": {
+                    "spec": {"template": {"spec": {"containers": [{"image": image}]}}}
+                }
+            }
+        }
+
+    lister = FakeLister([[cronjob("a:1"), cronjob("b:1")], [cronjob("a:1")], [{}]])
+    images = main.list_workload_images(
+        lister, main.WORKLOAD_SPEC_PATHS["CronJob"], page_size=2
+    )
+    assert images == {"a:1", "b:1"}
+    assert lister.calls == [(2, None), (2, "1"), (2, "2")]
+
+
+def test_get_images_from_workloads_merges_every_kind(monkeypatch):
+    def pod_spec(image):
+        return {"containers": [{"image": image}]}
+
+    listers = {
+        kind: FakeLister([[{"spec": {"template": {"spec": pod_spec(f"{kind}:1")}}}]])
+        for kind in ("DaemonSet", "Deployment", "StatefulSet", "Job")
+    }
+    listers["CronJob"] = FakeLister([[]])
+    listers["Pod"] = FakeLister([[{"spec": pod_spec("Job:1")}]])
+    monkeypatch.setattr(main, "get_workload_listers", lambda api_client: listers)
+    assert sorted(main.get_images_from_workloads()) == [
+        "DaemonSet:1",
+        "Deployment:1",
+        "Job:1",
+        "StatefulSet:1",
+    ]
+
+
+def test_get_images_from_clusters_merges_every_context(monkeypatch):
+    class FakeApiClient:
+        def __init__(self, context):
+            self.context = context
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(
+        main.config,
+        "new_client_from_config",
+        lambda context: FakeApiClient(context),
+    )
+    monkeypatch.setattr(
+        main,
+        "get_images_from_workloads",
+        lambda page_size, api_client, metrics: [
+            "shared:1",
+            f"{api_client.context}:1",
+        ],
+    )
+    assert sorted(main.get_images_from_clusters(["east", "west"])) == [
+        "east:1",
+        "shared:1",
+        "west:1",
+    ]
+
+
+ECR = "000000000000.dkr.ecr.us-east-1.amazonaws.com"
+
+
+@pytest.mark.parametrize(
+    "reference,result",
+    [
+        ("nginx", ("docker.io/library/nginx", "latest", None)),
+        ("nginx:1.25", ("docker.io/library/nginx", "1.25", None)),
+        ("bitnami/redis:7", ("docker.io/bitnami/redis", "7", None)),
+        ("index.docker.io/nginx", ("docker.io/library/nginx", "latest", None)),
+        ("localhost:5000/app", ("localhost:5000/app", "latest", None)),
+        (f"{ECR}/team/app:v1", (f"{ECR}/team/app", "v1", None)),
+        (f"{ECR}/team/app@sha256:abc", (f"{ECR}/team/app", None, "sha256:abc")),
+        (
+            f"{ECR}/team/app:v1@sha256:abc",
+            (f"{ECR}/team/app", "v1", "sha256:abc"),
+        ),
+    ],
+)
+def test_parse_image_reference(reference, result):
+    assert main.parse_image_reference(reference) == result
+
+
+@pytest.mark.parametrize(
+    "image,result",
+    [
+        (
+            {
+                "image_uri": f"{ECR}/team/app",
+                "imageTags": ["v2", "v1"],
+                "imageDigest": "sha256:other",
+            },
+            True,
+        ),
+        (
+            {
+                "image_uri": f"{ECR}/team/app",
+                "imageTags": ["v3"],
+                "imageDigest": "sha256:abc",
+            },
+            True,
+        ),
+        (
+            {"image_uri": f"{ECR}/team/app", "imageDigest": "sha256:def"},
+            True,
+        ),
+        (
+            {
+                "image_uri": f"{ECR}/team/app",
+                "imageTags": ["v4"],
+                "imageDigest": "sha256:none",
+            },
+            False,
+        ),
+        (
+            {
+                "image_uri": f"{ECR}/team/other",
+                "imageTags": ["v1"],
+                "imageDigest": "sha256:abc",
+            },
+            False,
+        ),
+    ],
+)
+def test_is_image_referenced_by_any_tag_or_digest(image, result):
+    index = main.ImageReferenceIndex(
+        [
+            f"{ECR}/team/app:v1",
+            f"{ECR}/team/app@sha256:abc",
+            f"{ECR}/team/app:v9@sha256:def",
+        ]
+    )
+    assert main.is_image_referenced(record(image), index) == result
+
+
+@pytest.mark.parametrize(
+    "image,images,result",
+    [
+        (
+            {
+                "image_uri": "test",
+                "imageTags": ["v1"],
+                "imagePushedAt": UTC.localize(datetime.now() - timedelta(1)),
+                "force_delete": True,
+            },
+            ["other"],
+            True,
+        ),
+        (
+            {"image_uri": "test", "imageTags": ["keep"], "force_delete": True},
+            ["other"],
+            False,
+        ),
+        (
+            {"image_uri": "test", "imageTags": ["keep"], "force_delete": True},
+            ["test:keep"],
+            False,
+        ),
+    ],
+)
+def test_is_image_deletable_force_delete(image, images, result):
+    assert main.is_image_deletable(record(image), images) == result
+
+
+@pytest.mark.parametrize(
+    "value,result",
+    [("false", True), ("False", True), ("", True), ("true", False), (None, False)],
+)
+def test_is_unapproved(value, result):
+    assert main.is_unapproved(value) == result
+
+
+class FakeTagClient:
+    def __init__(self, tags):
+        self.tags = tags
+        self.calls = []
+
+    def list_tags_for_resource(self, resourceArn):
+        self.calls.append(resourceArn)
+        return {"tags": self.tags.get(resourceArn, [])}
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class FakeTaggingClient:
+    def __init__(self, mappings=None, error=None):
+        self.mappings = mappings
+        self.error = error
+
+    def get_paginator(self, name):
+        if self.error:
+            raise self.error
+        return FakePaginator([{"ResourceTagMappingList": self.mappings}])
+
+
+def test_get_repository_approved_tags_from_tagging_api():
+    client = FakeTagClient({})
+    tagging_client = FakeTaggingClient(
+        [{"ResourceARN": "arn:a", "Tags": [{"Key": "Approved", "Value": "false"}]}]
+    )
+    assert main.get_repository_approved_tags(
+        client, ["arn:a", "arn:b"], tagging_client
+    ) == {"arn:a": "false", "arn:b": None}
+    assert client.calls == []
+
+
+def test_get_repository_approved_tags_falls_back_per_repository():
+    client = FakeTagClient({"arn:a": [{"Key": "Approved", "Value": "true"}]})
+    tagging_client = FakeTaggingClient(
+        error=main.ClientError(
+            {"Error": {"Code": "AccessDeniedException"}}, "GetResources"
+        )
+    )
+    assert main.get_repository_approved_tags(
+        client, ["arn:a", "arn:b"], tagging_client, concurrency=2
+    ) == {"arn:a": "true", "arn:b": None}
+    assert sorted(client.calls) == ["arn:a", "arn:b"]
+
+
+def test_get_repository_approved_tags_uses_cache(tmp_path):
+    cache_path = str(tmp_path / "tags.json")
+    client = FakeTagClient({"arn:a": [{"Key": "Approved", "Value": ""}]})
+    main.get_repository_approved_tags(client, ["arn:a"], cache_path=cache_path)
+    assert main.get_repository_approved_tags(
+        client, ["arn:a", "arn:new"], cache_path=cache_path
+    ) == {"arn:a": "", "arn:new": None}
+    assert client.calls == ["arn:a", "arn:new"]
+    assert main.load_tag_cache(cache_path, 0, main.time.time() + 1) == {}
+
+
+class FakeRepositoryClient(FakeTagClient):
+    def get_paginator(self, name):
+        return FakePaginator(
+            [
+                {
+                    "repositories": [
+                        {
+                            "registryId": "1",
+                            "repositoryName": name,
+                            "repositoryUri": f"ecr/{name}",
+                            "repositoryArn": f"arn:{name}",
+                        }
+                        for name in ("a", "b")
+                    ]
+                }
+            ]
+        )
+
+
+@pytest.mark.parametrize(
+    "delete_unapproved,deleted,calls",
+    [(False, [], []), (True, ["a"], ["arn:a", "arn:b"])],
+)
+def test_get_ecr_repositories_reads_tags_only_for_forced_deletion(
+    delete_unapproved, deleted, calls
+):
+    client = FakeRepositoryClient({"arn:a": [{"Key": "Approved", "Value": "false"}]})
+    repositories = main.get_ecr_repositories(
+        client, "1", delete_unapproved=delete_unapproved
+    )
+    assert [repo["repository_name"] for repo in repositories] == ["a", "b"]
+    assert [repo["repository_name"] for repo in repositories if repo.get("delete")] == (
+        deleted
+    )
+    assert client.calls == calls
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_iter_in_order_yields_in_item_order(concurrency):
+    def slow_for_small(item):
+        main.time.sleep(0.001 * (10 - item))
+        return item * 2
+
+    assert list(main.iter_in_order(slow_for_small, range(10), concurrency)) == [
+        item * 2 for item in range(10)
+    ]
+
+
+def test_evaluate_repository_includes_referring_artifacts():
+    old = UTC.localize(datetime.now() - timedelta(30))
+    images = [
+        record(
+            {
+                "image_uri": "repo",
+                "imageTags": ["old"],
+                "imageDigest": "sha256:old",
+                "imagePushedAt": old,
+            }
+        ),
+        record(
+            {
+                "image_uri": "repo",
+                "imageTags": ["used"],
+                "imageDigest": "sha256:used",
+                "imagePushedAt": old,
+            }
+        ),
+    ]
+    signature = record({"image_uri": "repo", "imageDigest": "sha256:sig"})
+    artifact_index = {"sha256:old": [signature], "sha256:used": [record({})]}
+    assert main.evaluate_repository(images, artifact_index, ["repo:used"]) == [
+        images[0],
+        signature,
+    ]
+
+
+def test_image_record_from_image():
+    repository = {
+        "registry_id": "1",
+        "repository_name": "team/app",
+        "repository_uri": f"{ECR}/team/app",
+    }
+    pushed = datetime(2024, 1, 1, tzinfo=UTC)
+    image = main.ImageRecord.from_image(
+        {
+            "registryId": "1",
+            "repositoryName": "team/app",
+            "imageDigest": "sha256:a",
+            "imageTags": ["v1", "latest"],
+            "imagePushedAt": pushed,
+            "imageManifestMediaType": "application/vnd.oci.image.manifest.v1+json",
+            "imageScanFindingsSummary": {"findingSeverityCounts": {"HIGH": 1}},
+        },
+        repository,
+    )
+    assert image.repository is repository
+    assert image.tags == ("v1", "latest")
+    assert image.pushed_at == int(pushed.timestamp())
+    assert image.pulled_at is None
+    assert image.image_uri == f"{ECR}/team/app:v1"
+    assert (image.registry_id, image.repository_name) == ("1", "team/app")
+    assert not hasattr(image, "__dict__")
+
+
+def test_deletable_mask_matches_is_image_deletable():
+    rng = random.Random(0)
+    now = datetime.now()
+    repositories = [
+        {"registry_id": "1", "repository_name": name, "repository_uri": f"{ECR}/{name}"}
+        for name in ("app", "web")
+    ] + [
+        {
+            "registry_id": "1",
+            "repository_name": "old",
+            "repository_uri": f"{ECR}/old",
+            "delete": True,
+        }
+    ]
+    images = []
+    for i in range(300):
+        image = {
+            "imageDigest": f"sha256:{i}",
+            "imageTags": rng.choice([[], [f"v{i}"], ["keep"], [f"v{i}", "keep"]]),
+        }
+        for key in ("imagePushedAt", "lastRecordedPullTime"):
+            if rng.random() < 0.8:
+                image[key] = UTC.localize(now - timedelta(rng.choice([1, 3, 20, 90])))
+        images.append(main.ImageRecord.from_image(image, rng.choice(repositories)))
+    references = main.ImageReferenceIndex(
+        [f"{ECR}/app:v{i}" for i in range(0, 300, 7)]
+        + [f"{ECR}/old@sha256:{i}" for i in range(0, 300, 5)]
+    )
+    policy = main.RetentionPolicy.from_now(push_window_days=7, pull_window_days=14)
+    expected = [main.is_image_deletable(image, references, policy) for image in images]
+    assert main.deletable_mask(images, references, policy) == expected
+    assert any(expected) and not all(expected)
+
+
+def test_retention_policy_matcher_first_rule_wins(tmp_path):
+    base = main.RetentionPolicy(0)
+    path = tmp_path / "policy.json"
+    path.write_text(
+        json.dumps(
+            {
+                "default": {"keep_last": 1},
+                "repositories": [
+                    {"match": "team-a/*", "keep_last": 10, "push_window_days": 30},
+                    {"regex": "team-.*", "protect_tags": ["^release-"]},
+                ],
+            }
+        )
+    )
+    policies = main.load_retention_policies(str(path), base)
+    assert len(policies) == 2
+    team_a = policies.policy_for("team-a/app")
+    assert (team_a.keep_last, team_a.push_window_days) == (10, 30)
+    assert team_a.pull_window_days == 7
+    team_b = policies.policy_for("team-b/app")
+    assert team_b.keep_last == 1
+    assert team_b.protects(("release-1",)) and not team_b.protects(("keep",))
+    assert policies.policy_for("other") == policies.default
+    assert policies.policy_for("team-a/app") is team_a
+
+
+def test_retention_policy_matcher_without_file():
+    base = main.RetentionPolicy(0)
+    assert main.load_retention_policies(None, base).policy_for("app") is base
+
+
+def test_retention_policy_rule_needs_a_pattern(tmp_path):
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps({"repositories": [{"keep_last": 1}]}))
+    with pytest.raises(ValueError):
+        main.load_retention_policies(str(path), main.RetentionPolicy(0))
+
+
+def test_retention_policy_matcher_keeps_uncombinable_patterns(tmp_path):
+    path = tmp_path / "policy.json"
+    path.write_text(
+        json.dumps(
+            {
+                "repositories": [
+                    {"regex": r"(a)\1-.*", "keep_last": 1},
+                    {"regex": "team-.*", "keep_last": 2},
+                    {"regex": "(?i)legacy-.*", "keep_last": 3},
+                    {"regex": "(?P<team>x)-.*", "keep_last": 4},
+                    {"regex": "(?P<team>y)-.*", "keep_last": 5},
+                    {"match": "*", "keep_last": 6},
+                ]
+            }
+        )
+    )
+    policies = main.load_retention_policies(str(path), main.RetentionPolicy(0))
+    assert len(policies) == 6
+    assert [
+        policies.policy_for(name).keep_last
+        for name in ("aa-app", "team-a", "LEGACY-app", "x-app", "y-app", "ab-app")
+    ] == [1, 2, 3, 4, 5, 6]
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        {"repositories": [{"match": "app", "keeplast": 1}]},
+        {"default": {"keep_last": "3"}},
+        {"default": {"keep_last": True}},
+        {"default": {"keep_last": -1}},
+        {"default": {"push_window_days": 1.5}},
+        {"default": {"protect_tags": "^keep$"}},
+        {"default": {"protect_tags": ["(unclosed"]}},
+        {"default": {"protect_tags": ["^keep$", "(?i)release"]}},
+        {"default": {"keep_last_prefixes": [1]}},
+        {"default": {"match": "app"}},
+        {"repositories": [{"match": "app", "regex": "app"}]},
+        {"repositories": [{"regex": "(unclosed"}]},
+        {"repositories": {"match": "app"}},
+        {"repository": []},
+    ],
+)
+def test_retention_policy_file_is_validated(tmp_path, document):
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps(document))
+    with pytest.raises(ValueError):
+        main.load_retention_policies(str(path), main.RetentionPolicy(0))
+
+
+def test_single_protected_tag_pattern_keeps_global_flags():
+    policy = main.policy_from_rule(
+        {"protect_tags": ["(?i)^release-"]}, main.RetentionPolicy(0)
+    )
+    assert policy.protects(("RELEASE-1",))
+
+
+def test_protected_tags_replace_keep():
+    image = record({"imageTags": ["release-1"]})
+    policy = main.RetentionPolicy(
+        int(datetime.now().timestamp()),
+        protect_tags=main.compile_tag_patterns(["^release-"]),
+    )
+    assert main.is_image_tagged_keep(image, policy)
+    assert not main.is_image_tagged_keep(image)
+    assert main.deletable_mask([image], [], policy) == [False]
+    assert main.deletable_mask([image], [], main.RetentionPolicy.from_now()) == [True]
+
+
+def test_evaluate_repository_keeps_last_images():
+    images = [
+        record(
+            {
+                "imageTags": [f"v{days}"],
+                "imageDigest": f"sha256:{days}",
+                "imagePushedAt": UTC.localize(datetime.now() - timedelta(days)),
+                "force_delete": force_delete,
+            }
+        )
+        for days, force_delete in ((30, False), (10, False), (20, False), (40, True))
+    ]
+    policy = main.RetentionPolicy(int(datetime.now().timestamp()), keep_last=2)
+    assert main.evaluate_repository(images, {}, [], policy) == [images[0], images[3]]
+
+
+def test_semver_key_orders_versions():
+    tags = ["1.10.0", "v1.2.0", "1.2.0-rc.1", "1.2.0-rc.10", "1.2.0-beta", "2.0.0"]
+    assert sorted(tags, key=main.semver_key) == [
+        "1.2.0-beta",
+        "1.2.0-rc.1",
+        "1.2.0-rc.10",
+        "v1.2.0",
+        "1.10.0",
+        "2.0.0",
+    ]
+    assert main.semver_key("latest") is None
+
+
+def test_keep_last_indexes_by_semver_per_prefix():
+    images = [
+        record({"imageTags": tags, "imagePushedAt": UTC.localize(datetime.now())})
+        for tags in (
+            ["release-1.9.0"],
+            ["release-1.10.0"],
+            ["release-1.2.0", "latest"],
+            ["rc-2.0.0"],
+            ["rc-1.0.0"],
+            ["feature"],
+        )
+    ]
+    policy = main.RetentionPolicy(
+        0, keep_last=2, keep_last_by="semver", keep_last_prefixes=("release-", "rc-")
+    )
+    assert main.keep_last_indexes(images, policy) == {0, 1, 3, 4}
+    policy = main.RetentionPolicy(0, keep_last=1, keep_last_by="semver")
+    assert main.keep_last_indexes(images, policy) == set()
+
+
+def test_keep_last_by_must_be_known():
+    with pytest.raises(ValueError):
+        main.policy_from_rule({"keep_last_by": "name"}, main.RetentionPolicy(0))
+
+
+def test_token_bucket_waits_for_refill():
+    now = [0.0]
+    waits = []
+    bucket = main.TokenBucket(2, clock=lambda: now[0], sleep=waits.append)
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.5]
+    assert waits == [0.5]
+    now[0] = 10.0
+    assert bucket.acquire() == 0.0
+
+
+def test_instrument_client_counts_calls_and_throttles():
+    client = boto3.client(
+        "ecr",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    metrics = main.instrument_client(client, {"DescribeRegistry": 1000})
+    operation = client.meta.service_model.operation_model("DescribeRegistry")
+    for _ in range(2):
+        client.meta.events.emit(
+            "before-call.ecr.DescribeRegistry", model=operation, params={}
+        )
+    for status, code in ((400, "ThrottlingException"), (200, None)):
+        client.meta.events.emit(
+            "needs-retry.ecr.DescribeRegistry",
+            operation=operation,
+            response=(
+                AWSResponse("https://ecr", status, {}, None),
+                {"Error": {"Code": code}} if code else {},
+            ),
+            caught_exception=None,
+            attempts=1,
+            endpoint=None,
+            request_dict={"context": {}},
+        )
+    summary = metrics.summary()["DescribeRegistry"]
+    assert (summary["calls"], summary["throttles"], summary["errors"]) == (2, 1, 0)
+
+
+@pytest.mark.parametrize(
+    "value,result",
+    [
+        (None, {}),
+        ("", {}),
+        ('{"DescribeRegistry": 5}', {"DescribeRegistry": 5.0}),
+        ('{"BatchDeleteImage": 0.5}', {"BatchDeleteImage": 0.5}),
+        # A bucket that never refills would wait forever
+        ('{"DescribeRegistry": 0}', ValueError),
+        ('{"DescribeRegistry": -1}', ValueError),
+    ],
+)
+def test_parse_rate_limits(value, result):
+    if result is ValueError:
+        with pytest.raises(ValueError):
+            main.parse_rate_limits(value)
+    else:
+        assert main.parse_rate_limits(value) == result
+
+
+class FailingDeleteClient(FakeDeleteClient):
+    def __init__(self, failures, error):
+        super().__init__(failures)
+        self.error = error
+
+    def batch_delete_image(self, registryId, repositoryName, imageIds):
+        if not self.calls:
+            self.calls.append([])
+            raise self.error
+        return super().batch_delete_image(registryId, repositoryName, imageIds)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        main.ClientError(
+            {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+            "BatchDeleteImage",
+        ),
+        EndpointConnectionError(endpoint_url="https://ecr"),
+        ReadTimeoutError(endpoint_url="https://ecr"),
+    ],
+)
+def test_delete_images_survives_client_errors(monkeypatch, error):
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    images = [
+        record({"registryId": "1", "repositoryName": "a", "imageDigest": f"d{i}"})
+        for i in range(2)
+    ]
+    client = FailingDeleteClient([], error)
+    assert main.delete_images(client, images) == []
+    assert client.calls == [[], ["d0", "d1"]]
+    assert len(sleeps) == 1
+
+
+def test_parse_targets():
+    assert main.parse_targets(None, "1") == [{"registry_id": "1"}]
+    targets = main.parse_targets(
+        '[{"region": "us-east-1", "role_arn": "arn:aws:iam::222222222222:role/cleanup"}]'
+    )
+    assert main.target_label(targets[0]) == "222222222222/us-east-1"
+    assert main.target_label({}) == "default/default"
+    with pytest.raises(ValueError):
+        main.parse_targets('[{"account": "1"}]')
+
+
+def test_target_session_refreshes_role_credentials(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "source")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    fetches = []
+
+    def fetch_credentials(self):
+        fetches.append(self._role_arn)
+        return {
+            "access_key": f"role{len(fetches)}",
+            "secret_key": "secret",
+            "token": "token",
+            # Already inside the refresh window, so every access assumes the role again
+            "expiry_time": (datetime.now(pytz.utc) + timedelta(minutes=1)).isoformat(),
+        }
+
+    monkeypatch.setattr(
+        main.AssumeRoleCredentialFetcher, "fetch_credentials", fetch_credentials
+    )
+    role_arn = "arn:aws:iam::222222222222:role/cleanup"
+    session = main.target_session({"region": "us-east-1", "role_arn": role_arn})
+    assert session.region_name == "us-east-1"
+    assert fetches == []
+    credentials = session.get_credentials()
+    assert credentials.get_frozen_credentials().access_key == "role1"
+    assert credentials.get_frozen_credentials().access_key == "role2"
+    assert fetches == [role_arn, role_arn]
+
+
+def test_target_path_only_splits_shared_runs():
+    target = {"registry_id": "1", "region": "us-west-2"}
+    assert main.target_path("/state/scan.json", target, False) == "/state/scan.json"
+    assert (
+        main.target_path("/state/scan.json", target, True)
+        == "/state/scan-1-us-west-2.json"
+    )
+    assert main.target_path(None, target, True) is None
+
+
+def test_combine_reports():
+    reports = [
+        {
+            "target": "1/a",
+            "repositories": 3,
+            "deletable_images": 2,
+            "reclaimed_bytes": 2048,
+        },
+        {"target": "2/a", "repositories": 1, "unresolved_failures": 1},
+        {"target": "3/a", "error": "AccessDenied"},
+    ]
+    assert main.combine_reports(reports)["totals"] == {
+        "repositories": 4,
+        "scanned_repositories": 0,
+        "deletable_images": 2,
+        "unresolved_failures": 1,
+        "reclaimed_bytes": 2048,
+        "failed_targets": 1,
+    }
+
+
+class VersionedLister(FakeLister):
+    def __call__(self, limit, _preload_content, _continue=None):
+        response = super().__call__(limit, _preload_content, _continue)
+        page = json.loads(response.data)
+        page["metadata"]["resourceVersion"] = "10"
+        return FakeListResponse(page)
+
+
+def pod(name, image, version="11"):
+    return {
+        "metadata": {"namespace": "default", "name": name, "resourceVersion": version},
+        "spec": {"containers": [{"image": image}]},
+    }
+
+
+def test_reference_cache_counts_objects():
+    cache = main.ReferenceCache()
+    cache.set(("c", "Pod", "ns", "a"), {"app:1"})
+    cache.set(("c", "Pod", "ns", "b"), {"app:1", "web:1"})
+    cache.set(("c", "Pod", "ns", "b"), set())
+    assert cache.counts == {"app:1": 1}
+    cache.replace_source(("c", "Pod"), {("ns", "c"): {"web:2"}})
+    assert set(cache.counts) == {"web:2"}
+    assert len(cache.snapshot()) == 1
+
+
+def test_workload_informer_applies_watch_events_and_resumes():
+    streams = [
+        [
+            {"type": "ADDED", "raw_object": pod("b", "web:1")},
+            {"type": "MODIFIED", "raw_object": pod("a", "app:2", "12")},
+            {"type": "DELETED", "raw_object": pod("b", "web:1", "13")},
+            {"type": "BOOKMARK", "raw_object": {"metadata": {"resourceVersion": "14"}}},
+        ],
+        [{"type": "ERROR", "raw_object": {"code": 410, "message": "too old"}}],
+        [],
+    ]
+    resumed_from = []
+
+    def stream(list_function, resource_version):
+        resumed_from.append(resource_version)
+        return streams.pop(0)
+
+    lister = VersionedLister([[pod("a", "app:1")]])
+    cache = main.ReferenceCache()
+    informer = main.WorkloadInformer(
+        (None, "Pod"), lister, ("spec",), cache, page_size=10, stream=stream
+    )
+    informer.watch_once()
+    assert informer.synced.is_set()
+    assert set(cache.counts) == {"app:2"}
+    informer.watch_once()
+    assert informer.resource_version is None
+    assert not informer.synced.is_set()
+    informer.watch_once()
+    assert informer.synced.is_set()
+    assert resumed_from == ["10", "14", "10"]
+    assert len(lister.calls) == 2
+    assert set(cache.counts) == {"app:1"}
+    assert cache.snapshot().references_image(
+        record({"image_uri": "docker.io/library/app", "imageTags": ["1"]})
+    )
+
+
+def test_failed_watch_skips_sweeps_until_resumed():
+    stop = main.threading.Event()
+
+    def failing_stream(list_function, resource_version):
+        stop.set()
+        raise ConnectionError("connection refused")
+
+    cache = main.ReferenceCache()
+    informers = [
+        main.WorkloadInformer(
+            (None, kind), VersionedLister([[pod("a", "app:1")]]), ("spec",), cache
+        )
+        for kind in ("Pod", "Job")
+    ]
+    for informer in informers:
+        informer.relist()
+    metrics = main.RunMetrics()
+    assert main.informers_synced(informers, metrics)
+    informers[0].stream = failing_stream
+    informers[0].run(stop)
+    assert not main.informers_synced(informers, metrics)
+    assert "ecr_cleanup_unsynced_informers 1" in metrics.render()
+    informers[0].stream = lambda list_function, resource_version: []
+    informers[0].watch_once()
+    assert main.informers_synced(informers, metrics)
+    assert "ecr_cleanup_unsynced_informers 0" in metrics.render()
+
+
+def test_run_metrics_render(tmp_path):
+    metrics = main.RunMetrics()
+    metrics.inc("images_deleted_total", 2, target="1/us-east-1")
+    metrics.inc("images_deleted_total", 3, target="1/us-east-1")
+    metrics.set("failed_targets", 0)
+    with metrics.phase("deletion", target='a"b'):
+        pass
+    client_metrics = main.ClientMetrics()
+    client_metrics.record_call("BatchDeleteImage")
+    client_metrics.record_attempt("BatchDeleteImage", "ThrottlingException")
+    client_metrics.record_attempt("BatchDeleteImage", None)
+    metrics.add_client_metrics(client_metrics, target="1/us-east-1")
+    text = metrics.render()
+    assert 'ecr_cleanup_images_deleted_total{target="1/us-east-1"} 5\n' in text
+    assert "ecr_cleanup_failed_targets 0\n" in text
+    assert 'phase="deletion",target="a\\"b"}' in text
+    assert (
+        'ecr_cleanup_api_retries_total{operation="BatchDeleteImage",target="1/us-east-1"} 1'
+        in text
+    )
+    assert text.count("# TYPE ecr_cleanup_images_deleted_total counter") == 1
+    path = tmp_path / "ecr_cleanup.prom"
+    main.write_metrics_textfile(str(path), text)
+    assert path.read_text() == text
+    assert [p.name for p in tmp_path.iterdir()] == ["ecr_cleanup.prom"]
+
+
+def test_image_record_size():
+    assert record({"imageSizeInBytes": 1024}).size == 1024
+    assert record({}).size is None
+
+
+def test_profiler_writes_report(tmp_path):
+    profiler = main.Profiler(str(tmp_path))
+    metrics = main.RunMetrics(profiler)
+    # The sweep only takes snapshots so the evaluation inside it can profile functions
+    with metrics.profile("sweep", functions=False):
+        with metrics.profile("evaluation", allocations=False):
+            main.deletable_mask(
+                [record({"imageTags": [f"v{i}"]}) for i in range(50)],
+                [],
+                main.RetentionPolicy.from_now(),
+            )
+    with profiler.profiling:
+        # Another call holds cProfile, this one only gets timing and allocations
+        with profiler.phase("deletion"):
+            pass
+    path = profiler.write_report()
+    report = open(path).read()
+    sections = dict(section.split("\n", 1) for section in report.split("=== ")[1:])
+    headers = {header.split(":")[0]: header for header in sections}
+    assert headers["evaluation"].endswith("in 1 calls, 1 profiled")
+    assert headers["deletion"].endswith("in 1 calls, 0 profiled")
+    evaluation = sections[headers["evaluation"]]
+    assert "deletable_mask" in evaluation
+    assert "hot functions by tottime" in evaluation
+    assert "top allocation sites" not in evaluation
+    sweep = sections[headers["sweep"]]
+    assert "hot functions" not in sweep
+    assert "top allocation sites" in sweep
+    assert (tmp_path / f"profile-{profiler.started}-evaluation.pstats").exists()
+    assert not main.tracemalloc.is_tracing()